@@ -3,37 +3,31 @@
 """
 Minerva Command Line Client
 """
-import argparse, configparser
-import sys, logging, os
+import argparse, configparser, functools
+import sys, logging, os, signal
 import pathlib
 from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
 
 from . import __version__
 from minerva_cli.util.configurer import Configurer
-from minerva_lib.importing import MinervaImporter
-from minerva_lib.exporting import MinervaExporter
-from minerva_lib.client import MinervaClient, InvalidUsernameOrPassword, InvalidCognitoClientId
-from minerva_lib.util.s3 import S3Uploader
-from minerva_lib.util.fileutils import FileUtils
-from tqdm import tqdm
-import tabulate
+from minerva_cli.util.units import parse_size
+from minerva_cli.util.selection import ExportSelection, parse_indices, parse_roi
+from minerva_cli.util.output import print_table, is_machine_readable, RowPrinter, EXPORT_FORMATS, EXPORT_COMPRESSIONS, OUTPUT_FORMATS
+
+# Modules which pull in boto3, zarr, tifffile etc. are imported only inside the commands
+# which need them, so that e.g. "minerva --help" and "minerva configure" start quickly.
 
 BATCH_IMPORT_FILE_FILTER = [".tif", ".rcpnl", ".dv"]
 LOCAL_IMPORT_FILE_FILTER = [".tif"]
-TILE_PATTERN = "C\\d+-T\\d+-Z\\d+-L\\d+-Y\\d+-X\\d+\\.png"
+# Images stored as directories, imported as a whole
+LOCAL_IMPORT_DIRECTORY_FILTER = [".zarr"]
 
 logger = logging.getLogger("minerva")
-logging_level = logging.DEBUG if "--debug" in sys.argv else logging.WARNING
-minerva_logging_level = logging.DEBUG if "--debug" in sys.argv else logging.INFO
 FORMAT = '%(asctime)-15s %(levelname)-8s - %(message)s'
-logging.basicConfig(stream=sys.stdout, level=logging_level, format=FORMAT)
-logging.getLogger('minerva').setLevel(minerva_logging_level)
-
-if "--dryrun" in sys.argv:
-    logger.info("DRY RUN")
 
 class Configuration:
-    def __init__(self, repository=None, directory=None, file=None, archive=None, image_name=None, image_uuid=None, output=None, save_pyramid=False, dryrun=False, local_import=False, export_format="zarr", region="us-east-1"):
+    def __init__(self, repository=None, directory=None, file=None, archive=None, image_name=None, image_uuid=None, output=None, save_pyramid=False, dryrun=False, local_import=False, export_format="zarr", region="us-east-1", workers=1, max_memory=None, upload_concurrency=None, concurrency=10, prefetch_levels=1, output_format=None, metadata_cache=None, page_size=500, import_index=None, use_hash=False, upload_state=None, part_size=None, part_concurrency=None, no_wait=False, watch=False, profiler=None, channels=None, level=0, roi=None, timepoint=0, z=0, compression=None, tile_size=None, writer_threads=None, manifest=None, jobs=None, retries=None, report=None, transfer=None, encoders=None, output_stream=None):
         self.repository = repository
         self.directory = directory
         self.file = file
@@ -46,6 +40,38 @@ class Configuration:
         self.local_import = local_import
         self.export_format = export_format
         self.region = region
+        self.workers = workers
+        self.max_memory = max_memory
+        self.upload_concurrency = upload_concurrency
+        self.concurrency = concurrency
+        self.prefetch_levels = prefetch_levels
+        self.output_format = output_format
+        self.metadata_cache = metadata_cache
+        self.page_size = page_size
+        self.import_index = import_index
+        self.use_hash = use_hash
+        self.upload_state = upload_state
+        self.part_size = part_size
+        self.part_concurrency = part_concurrency
+        self.no_wait = no_wait
+        self.watch = watch
+        self.profiler = profiler
+        self.channels = channels
+        self.level = level
+        self.roi = roi
+        self.timepoint = timepoint
+        self.z = z
+        self.compression = compression
+        self.tile_size = tile_size
+        self.writer_threads = writer_threads
+        self.manifest = manifest
+        self.jobs = jobs
+        self.retries = retries
+        self.report = report
+        self.transfer = transfer
+        self.encoders = encoders
+        # Commands print their results to sys.stdout, unless another stream is given
+        self.output_stream = output_stream
 
 def check_required_arguments(args):
     exit = False
@@ -57,16 +83,25 @@ def check_required_arguments(args):
     if exit:
         sys.exit(1)
 
-def parse_arguments():
+def parse_arguments(argv=None):
     epilog = """
 Examples:
 Import whole directory: minerva import -r REPOSITORY_NAME -d /directory
 Import single file: \tminerva import -r REPOSITORY_NAME -f /path/file
-(When importing only OME-TIFFs, --local flag can be used to optimize the process)
+(When importing only OME-TIFFs or OME-zarr directories, --local flag can be used to optimize the process)
+Import directory locally: 	minerva import -r REPOSITORY_NAME -d /directory --local --workers 4
+Import OME-zarr locally: 	minerva import -r REPOSITORY_NAME -f /path/image.zarr --local
 Export image: \t\tminerva export --id IMAGE_UUID
+Export compressed: \tminerva export --id IMAGE_UUID --format tif --pyramid --compression zstd --writer-threads 8
+Export a region: \tminerva export --id IMAGE_UUID --format tif --channels 0,2-4 --roi 1000,2000,512,512
+Profile an export: \tminerva export --id IMAGE_UUID --profile export-trace.json
 List repositories: \tminerva repositories
 List images: \t\tminerva images -r REPOSITORY_NAME
+List images as JSON: \tminerva images -r REPOSITORY_NAME --format json
 Show import status: \tminerva status
+Follow import status: \tminerva status --watch
+Run a manifest of jobs:\tminerva run jobs.csv --jobs 8 --report results.csv
+Start a daemon: \tminerva daemon
 Configure Minerva CLI:\tminerva configure
     """
     parser = argparse.ArgumentParser(prog="minerva",
@@ -74,8 +109,9 @@ Configure Minerva CLI:\tminerva configure
                                      epilog=epilog,
                                      formatter_class=argparse.RawTextHelpFormatter)
 
-    parser.add_argument('command', choices=["import", "export", "repositories", "status", "configure", "images"], type=str,
-                        help='[import=Import images, export=Export image, repositories=List repositories, images=List images, status=Show import status, configure=Configure]')
+    parser.add_argument('command', choices=["import", "export", "repositories", "status", "configure", "images", "run", "daemon"], type=str,
+                        help='[import=Import images, export=Export image, repositories=List repositories, images=List images, status=Show import status, configure=Configure, run=Run jobs of a manifest, daemon=Serve listings from a background process]')
+    parser.add_argument('manifest', nargs='?', help='CSV or YAML file of import and export jobs (for run)')
     parser.add_argument('--config', type=str,
                         help='Config file')
     parser.add_argument('--dir', '-d', type=str,
@@ -94,32 +130,102 @@ Configure Minerva CLI:\tminerva configure
                         help='Image uuid (for export)')
     parser.add_argument('--output', '-o', type=str,
                         help='Output path (for export)')
-    parser.add_argument('--format', choices=["zarr", "tif", "tiff"],
-                        help='Export format')
+    parser.add_argument('--format', choices=EXPORT_FORMATS + OUTPUT_FORMATS,
+                        help='Export format (zarr, tif) or output format of listings and import results (table, json, csv)')
     parser.add_argument('--pyramid', '-p', dest='pyramid', action='store_true',
                         help='Save pyramid (for export)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Number of tiles downloaded or API requests made in parallel')
+    parser.add_argument('--prefetch-levels', type=int, default=1,
+                        help='Number of pyramid levels downloaded ahead of the OME-TIFF writer (for export)')
+    parser.add_argument('--channels', type=parse_indices, help='Channels to export, e.g. 0,2-4 (for export)')
+    parser.add_argument('--level', type=int, default=0, help='Pyramid level to export, or the first level with --pyramid (for export)')
+    parser.add_argument('--roi', type=parse_roi, metavar='X,Y,W,H',
+                        help='Region to export in full resolution pixels (for export)')
+    parser.add_argument('--timepoint', type=int, default=0, help='Timepoint to export (for export)')
+    parser.add_argument('--z', type=int, default=0, help='Z-plane to export (for export)')
+    parser.add_argument('--compression', choices=EXPORT_COMPRESSIONS,
+                        help='Compression of the exported tiles, lz4 only for zarr (for export)')
+    parser.add_argument('--tile-size', type=int, help='Tile or chunk size of the exported image (for export)')
+    parser.add_argument('--writer-threads', type=int, help='Threads reading and encoding exported tiles, default: CPU count')
+    parser.add_argument('--jobs', type=int, help='Number of manifest jobs run at once (for run), default 4')
+    parser.add_argument('--retries', type=int, help='Number of times a failed job is retried (for run), default 2')
+    parser.add_argument('--report', type=str, help='Save the results of the jobs as CSV or JSON (for run)')
     parser.add_argument('--imagename', '-n', type=str, help='Image name (direct import)')
-    parser.add_argument('--local', '-l', action='store_const', const=True, help='Use local import', default=False)
+    parser.add_argument('--local', '-l', action='store_const', const=True, help='Use local import (OME-TIFF and OME-zarr)', default=False)
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Number of files imported in parallel (local import)')
+    parser.add_argument('--max-memory', type=parse_size, help='Memory budget shared by local import workers, e.g. 500M')
+    parser.add_argument('--upload-concurrency', type=int, help='Maximum concurrent tile uploads shared by local import workers')
+    parser.add_argument('--encoders', type=int, help='Number of processes compressing the tiles of each file in local import (default: CPUs divided by workers)')
+    parser.add_argument('--reimport', action='store_const', const=True, help='Import also files which have been imported already', default=False)
+    parser.add_argument('--hash', action='store_const', const=True, help='Detect changed files by content hash (for import)', default=False)
+    parser.add_argument('--max-bandwidth', type=parse_size, metavar='BYTES',
+                        help='Maximum S3 transfer rate per second for import and export, e.g. 50M')
+    parser.add_argument('--part-size', type=parse_size, default="16M", help='Part size of multipart uploads (batch import)')
+    parser.add_argument('--part-concurrency', type=int, default=8, help='Number of parts uploaded in parallel (batch import)')
+    parser.add_argument('--no-wait', action='store_const', const=True, help='Do not wait for the import to be processed', default=False)
+    parser.add_argument('--watch', action='store_const', const=True, help='Follow the progress of all incomplete imports (for status)', default=False)
     parser.add_argument('--archive', action='store_const', const=True, help='Archive original images', default=False)
+    parser.add_argument('--no-token-cache', action='store_const', const=True, help='Do not cache authentication tokens', default=False)
+    parser.add_argument('--no-cache', action='store_const', const=True, help='Do not cache repository metadata', default=False)
+    parser.add_argument('--cache-ttl', type=int, default=300, help='Seconds before cached repository metadata is revalidated')
+    parser.add_argument('--page-size', type=int, default=500, help='Number of rows requested per page of a listing')
+    parser.add_argument('--profile', type=str, metavar='PATH', help='Save timings of each import/export stage as a Chrome trace JSON file')
+    parser.add_argument('--cprofile', action='store_const', const=True, help='Save also a cProfile profile as PATH.pstats (with --profile)', default=False)
+    parser.add_argument('--stop', action='store_const', const=True, help='Stop the running daemon (for daemon)', default=False)
+    parser.add_argument('--no-daemon', action='store_const', const=True, help='Do not forward the command to a running daemon', default=False)
     parser.add_argument('--debug', action='store_const', const=True, help='Debug logging on')
     parser.add_argument('--dryrun', action='store_const', const=True, help='Dry run', default=False)
 
-    if len(sys.argv) == 1:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 0:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
-def print_results(client, import_uuid):
-    print("\n")
+def print_results(client, import_uuid, output_format=None, concurrency=10, stream=None):
+    from minerva_cli.util.api import pool_connections
+
+    pool_connections(client, concurrency)
     result = client.list_filesets_in_import(import_uuid)
-    for fileset in result["data"]:
-        result = client.list_images_in_fileset(fileset["uuid"])
-        print(tabulate.tabulate(result["data"], headers="keys"))
-        print("\n")
+    # Images of all filesets are fetched concurrently, and printed as one table
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(lambda fileset: client.list_images_in_fileset(fileset["uuid"]), result["data"])
+        images = [image for result in results for image in result["data"]]
+
+    if not is_machine_readable(output_format):
+        print("\n", file=stream or sys.stdout)
+    print_table(images, output_format, stream)
+
+def create_minerva_client(endpoint, region, client_id, username, password, token_cache=None):
+    from minerva_lib.client import MinervaClient
+    from minerva_cli.util.api import retry_unauthorized
 
-def create_minerva_client(endpoint, region, client_id, username, password):
     client = MinervaClient(endpoint=endpoint, region=region, cognito_client_id=client_id)
+    authenticate(client, username, password, token_cache)
+    retry_unauthorized(client, functools.partial(login_again, client, username, password, token_cache))
+    return client
+
+def authenticate(client, username, password, token_cache=None):
+    if token_cache is not None and token_cache.restore(client, username):
+        return
+    login(client, username, password, token_cache)
+
+def login_again(client, username, password, token_cache=None):
+    """
+    Authenticates with the password after the API has rejected the tokens, which are removed from the cache.
+    """
+    if token_cache is not None:
+        token_cache.invalidate(client, username)
+    login(client, username, password, token_cache)
+
+def login(client, username, password, token_cache=None):
+    """
+    Authenticates with the password, and caches the new tokens.
+    """
+    from minerva_lib.client import InvalidUsernameOrPassword, InvalidCognitoClientId
+
     try:
         client.authenticate(username, password)
     except InvalidUsernameOrPassword as e:
@@ -128,7 +234,9 @@ def create_minerva_client(endpoint, region, client_id, username, password):
     except InvalidCognitoClientId as e:
         logger.error("Check the value for CognitoClient!")
         sys.exit(1)
-    return client
+
+    if token_cache is not None:
+        token_cache.store(client, username)
 
 def execute_command(command, client, cfg):
     command = command.lower()
@@ -137,28 +245,41 @@ def execute_command(command, client, cfg):
 
     elif command == 'repositories':
         logger.info("Listing repositories:")
-        result = client.list_repositories()
+        if cfg.metadata_cache is not None:
+            # Revalidated on every listing, which costs only a conditional request when nothing has changed
+            result = cfg.metadata_cache.get(client, '/repository', max_age=0)
+        else:
+            result = client.list_repositories()
         repositories = result["included"]["repositories"]
         for repo in repositories:
             for grant in result["data"]:
                 if grant["repository_uuid"] == repo["uuid"]:
                     repo["permission"] = grant["permission"]
 
-        print(tabulate.tabulate(repositories, headers="keys"))
+        print_table(repositories, cfg.output_format)
 
     elif command == 'images':
         logger.info("Listing images:")
         if not cfg.repository:
             logger.error("Need to pass repository with -r repository_name")
             return -1
-        res = client.list_repositories()
-        existing_repository = list(filter(lambda x: x["name"] == cfg.repository, res["included"]["repositories"]))
-        if not existing_repository or len(existing_repository) == 0:
+        from minerva_cli.util.api import iter_pages
+
+        repository = _find_repository(client, cfg)
+        if repository is None:
             logger.error("Repository %s not found", cfg.repository)
             return -1
-        repository_uuid = existing_repository[0]["uuid"]
-        result = client.list_images_in_repository(repository_uuid)
-        print(tabulate.tabulate(result["data"], headers="keys"))
+        # Images are printed page by page as they arrive
+        printer = RowPrinter(cfg.output_format)
+        for page in iter_pages(client, '/repository/' + repository["uuid"] + '/images', page_size=cfg.page_size):
+            printer.write(page)
+        printer.close()
+
+    elif command == 'status' and cfg.watch:
+        from minerva_cli.util.watch import ImportWatcher
+
+        logger.info("Watching import status:")
+        ImportWatcher(client).watch()
 
     elif command == 'status':
         logger.info("Showing import status:")
@@ -167,26 +288,46 @@ def execute_command(command, client, cfg):
             logger.info("No imports are processing currently.")
         else:
             logger.info("Following filesets are currently processing:")
-            print(tabulate.tabulate(result["included"]["filesets"], headers="keys"))
+            print_table(result["included"]["filesets"], cfg.output_format)
 
     elif command == 'export':
         return export(cfg, client)
 
+    elif command == 'run':
+        return run_manifest(cfg, client)
+
     elif command == 'configure':
         configurer = Configurer()
         configurer.interactive_config()
 
     return 0
 
-def _get_files(file_or_directory: str, filefilter=None):
+def _find_repository(client, cfg):
+    if cfg.metadata_cache is not None:
+        return cfg.metadata_cache.find_repository(client, cfg.repository)
+
+    res = client.list_repositories()
+    existing_repository = list(filter(lambda x: x["name"] == cfg.repository, res["included"]["repositories"]))
+    return existing_repository[0] if existing_repository else None
+
+def _get_files(file_or_directory: str, filefilter=None, dirfilter=()):
+    from minerva_cli.util.import_index import scan_files, scan_file, ScannedFile
+
     files = []
     if file_or_directory != '' and os.path.isdir(file_or_directory):
-        files += (FileUtils.list_files(file_or_directory, filefilter=filefilter))
+        if os.path.splitext(os.path.normpath(file_or_directory))[1] in dirfilter:
+            files.append(scan_file(file_or_directory))
+        else:
+            files += scan_files(file_or_directory, filefilter=filefilter, dirfilter=dirfilter)
+    elif os.path.isfile(file_or_directory):
+        files.append(scan_file(file_or_directory))
     else:
-        files.append(file_or_directory)
+        files.append(ScannedFile(file_or_directory, None, None))
     return files
 
 def _import(cfg, client):
+    from minerva_lib.util.fileutils import FileUtils
+
     if not cfg.file and not cfg.directory:
         logger.error("Define either a directory with -d or file with -f to import.")
         return -1
@@ -194,12 +335,23 @@ def _import(cfg, client):
     FileUtils.validate_name(cfg.repository, "Repository")
 
     file_or_directory = cfg.directory if len(cfg.file) == 0 else cfg.file
-    filefilter = LOCAL_IMPORT_FILE_FILTER if cfg.local_import else BATCH_IMPORT_FILE_FILTER
-    files = _get_files(file_or_directory, filefilter=filefilter)
+    if cfg.local_import:
+        files = _get_files(file_or_directory, filefilter=LOCAL_IMPORT_FILE_FILTER, dirfilter=LOCAL_IMPORT_DIRECTORY_FILTER)
+    else:
+        files = _get_files(file_or_directory, filefilter=BATCH_IMPORT_FILE_FILTER)
     if len(files) == 0:
         logger.error("No files found.")
         return -1
 
+    if cfg.import_index is not None:
+        new_files = cfg.import_index.filter_new(cfg.repository, files, use_hash=cfg.use_hash)
+        if len(new_files) < len(files):
+            logger.info("Skipping %s files already imported into repository %s", len(files) - len(new_files), cfg.repository)
+        if len(new_files) == 0:
+            logger.info("All files have already been imported. Use --reimport to import them again.")
+            return 0
+        files = new_files
+
     if cfg.local_import:
         logger.info("Processing images locally.")
         return _local_import(cfg, client, files)
@@ -212,6 +364,8 @@ def _batch_import(cfg, client, files):
     Batch import uploads the original image files into S3 raw bucket,
     and starts an AWS Batch Job to process the images.
     """
+    from minerva_cli.util.uploader import BatchImporter, MultipartUploader
+
     check_required_arguments([cfg.repository, "Repository"])
 
     if cfg.directory:
@@ -219,11 +373,20 @@ def _batch_import(cfg, client, files):
     else:
         logger.info("Importing file: %s", cfg.file)
 
-    importer = MinervaImporter(client, uploader=S3Uploader(region=cfg.region), dryrun=cfg.dryrun)
-
-    import_uuid = importer.import_files(files=files, repository=cfg.repository)
+    output = cfg.output_stream or sys.stdout
+    # Keep the output clean of progress when it is parsed by other tools
+    progress = sys.stderr if is_machine_readable(cfg.output_format) else output
+    uploader = MultipartUploader(cfg.region, cfg.upload_state, part_size=cfg.part_size, part_concurrency=cfg.part_concurrency,
+                                 profiler=cfg.profiler, transfer=cfg.transfer)
+    importer = BatchImporter(client, uploader=uploader, state=cfg.upload_state, dryrun=cfg.dryrun, output=progress)
+
+    import_uuid = importer.import_files(files=[file.path for file in files], repository=cfg.repository)
+    _record_imported(cfg, files)
+    if cfg.no_wait:
+        logger.info("Import %s started. Follow its progress with \"minerva status --watch\"", import_uuid)
+        return 0
     importer.poll_import_progress(import_uuid)
-    print_results(client, import_uuid)
+    print_results(client, import_uuid, cfg.output_format, concurrency=cfg.concurrency, stream=output)
     return 0
 
 def _local_import(cfg, client, files):
@@ -231,70 +394,193 @@ def _local_import(cfg, client, files):
     Local import process the images on local machine,
     after which the tiles are uploaded into S3 tile bucket.
     """
+    from minerva_cli.util.local_import import run_local_import
+
     check_required_arguments([(cfg.repository, "Repository")])
 
-    importer = MinervaImporter(client, uploader=S3Uploader(region=cfg.region), dryrun=cfg.dryrun)
+    results = run_local_import(client, cfg, [file.path for file in files])
+    imported = set(result["file"] for result in results if result["status"] == "imported")
+    _record_imported(cfg, [file for file in files if file.path in imported])
+    if len(results) > 1 or is_machine_readable(cfg.output_format):
+        print_table(results, cfg.output_format, cfg.output_stream)
 
-    status_code = 0
-    for file in files:
-        if not os.path.exists(file):
-            logger.warning("File does not exist: %s", file)
-            return -1
+    if any(result["status"] in ("missing", "failed") for result in results):
+        return -1
+    return 0
 
-        if not os.path.basename(file).endswith(".ome.tif"):
-            logger.warning("Only OME-TIFFs can be imported with local import.")
-            logger.warning("Skipping file %s", file)
-            continue
+def _record_imported(cfg, files):
+    if cfg.import_index is not None and not cfg.dryrun:
+        cfg.import_index.add(cfg.repository, files, use_hash=cfg.use_hash)
 
-        logger.info("Importing file %s", file)
-        with tqdm(unit="tiles") as pbar:
-            def show_progress(processed, total):
-                pbar.total = total
-                pbar.update(1)
+def run_manifest(cfg, client):
+    """
+    Runs the import and export jobs of a manifest in this process, sharing one authenticated client.
+    """
+    from minerva_cli.util.jobs import JobRunner, load_manifest, write_report, DEFAULT_JOB_CONCURRENCY, DEFAULT_JOB_RETRIES
 
-            try:
-                importer.import_ome_tiff(file,
-                                         repository=cfg.repository,
-                                         progress_callback=show_progress,
-                                         image_name=cfg.image_name)
-            except Exception as e:
-                status_code = -1
-                raise e
+    if not cfg.manifest:
+        logger.error("Give the manifest file, e.g. minerva run jobs.csv")
+        return -1
+    try:
+        jobs = load_manifest(cfg.manifest, cfg)
+    except (OSError, ValueError) as e:
+        logger.error("Could not read manifest %s: %s", cfg.manifest, e)
+        return -1
 
-    return status_code
+    runner = JobRunner(client, execute_command,
+                       concurrency=cfg.jobs or DEFAULT_JOB_CONCURRENCY,
+                       retries=cfg.retries if cfg.retries is not None else DEFAULT_JOB_RETRIES)
+    results = runner.run(jobs)
+    if cfg.report:
+        write_report(cfg.report, results)
+        logger.info("Job report saved as %s", cfg.report)
+    print_table(results, cfg.output_format)
+    return 0 if all(result["status"] == "ok" for result in results) else -1
 
 def export(cfg, client):
     """
     Export downloads all the tiles from S3 tile bucket, and reconstructs an OME-TIFF file with metadata.
+    Tiles which have already been downloaded by an interrupted export are not downloaded again.
     """
-    exporter = MinervaExporter(cfg.region)
+    from minerva_cli.util.exporter import TileExporter
+    from tqdm import tqdm
+
+    if cfg.export_format not in EXPORT_FORMATS + [None]:
+        logger.error("Export format must be one of: %s", ", ".join(EXPORT_FORMATS))
+        return -1
+
+    exporter = TileExporter(cfg.region, concurrency=cfg.concurrency, prefetch_levels=cfg.prefetch_levels, profiler=cfg.profiler,
+                            compression=cfg.compression, tile_size=cfg.tile_size, writer_threads=cfg.writer_threads,
+                            transfer=cfg.transfer)
 
     if cfg.image_uuid is None:
         logger.error("Image uuid has to be specified with argument --id")
         return -1
     logger.info("Exporting image uuid: %s (pyramid=%s)", cfg.image_uuid, cfg.save_pyramid)
+    selection = ExportSelection(channels=cfg.channels, level=cfg.level, roi=cfg.roi, timepoint=cfg.timepoint, z=cfg.z)
     try:
         uuid_obj = UUID(cfg.image_uuid, version=4)
+    except ValueError:
+        logger.error("%s is not a valid UUID", cfg.image_uuid)
+        return -1
+
+    try:
         with tqdm(unit="tiles") as pbar:
             def show_progress(processed, total):
                 pbar.total = total
-                pbar.update(1)
+                pbar.update(processed - pbar.n)
 
-            output = exporter.export_image(client, str(uuid_obj), cfg.output, save_pyramid=cfg.save_pyramid, progress_callback=show_progress, format=cfg.export_format)
+            output = exporter.export_image(client, str(uuid_obj), cfg.output, save_pyramid=cfg.save_pyramid, progress_callback=show_progress, format=cfg.export_format,
+                                          selection=selection)
 
+        logger.info(exporter.stats.report())
         logger.info("Image saved as %s", output)
 
-    except ValueError:
-        logger.error("%s is not a valid UUID", cfg.image_uuid)
-        return -1
     except Exception as e:
         logger.error(e)
         return -1
 
     return 0
 
+def create_configuration(args, region, profiler=None, metadata_cache=None, import_index=None, upload_state=None, transfer=None):
+    return Configuration(repository=args.repository,
+                         directory=args.dir,
+                         file=args.file,
+                         archive=args.archive,
+                         image_name=args.imagename,
+                         image_uuid=args.id,
+                         output=args.output,
+                         save_pyramid=args.pyramid,
+                         dryrun=args.dryrun,
+                         local_import=args.local,
+                         export_format=_export_format(args),
+                         region=region,
+                         workers=args.workers,
+                         max_memory=args.max_memory,
+                         upload_concurrency=args.upload_concurrency,
+                         encoders=args.encoders,
+                         concurrency=args.concurrency,
+                         prefetch_levels=args.prefetch_levels,
+                         output_format=args.format if args.format in OUTPUT_FORMATS else None,
+                         metadata_cache=metadata_cache,
+                         page_size=args.page_size,
+                         import_index=import_index,
+                         use_hash=args.hash,
+                         upload_state=upload_state,
+                         part_size=args.part_size,
+                         part_concurrency=args.part_concurrency,
+                         no_wait=args.no_wait,
+                         watch=args.watch,
+                         profiler=profiler,
+                         channels=args.channels,
+                         level=args.level,
+                         roi=args.roi,
+                         timepoint=args.timepoint,
+                         z=args.z,
+                         compression=args.compression,
+                         tile_size=args.tile_size,
+                         writer_threads=args.writer_threads,
+                         manifest=args.manifest,
+                         jobs=args.jobs,
+                         retries=args.retries,
+                         report=args.report,
+                         transfer=transfer)
+
+def _export_format(args):
+    # Export rejects output formats such as json, for run --format is either the default export format of the jobs
+    # or the format of the job report
+    if args.command == "export":
+        return args.format
+    if args.command == "run" and args.format in EXPORT_FORMATS:
+        return args.format
+    return None
+
+def run_daemon(args, config, client, region, username, password, token_cache):
+    from minerva_cli.util.api import pool_connections, MetadataCache
+    from minerva_cli.util.daemon import Daemon, DAEMON_COMMANDS, is_daemon_command, socket_path
+    from minerva_cli.util.tokencache import expires_soon
+
+    pool_connections(client, args.concurrency)
+
+    def handle(argv):
+        request = parse_arguments(argv)
+        if not is_daemon_command(request):
+            logger.error("The daemon runs only the commands %s", ", ".join(DAEMON_COMMANDS))
+            return -1
+        # The daemon outlives the tokens, which are renewed shortly before they expire
+        if expires_soon(client.id_token):
+            authenticate(client, username, password, token_cache)
+        metadata_cache = None
+        if not request.no_cache:
+            metadata_cache = MetadataCache(os.path.join(os.path.dirname(config), ".minerva_cache"), ttl=request.cache_ttl)
+        return execute_command(request.command, client, create_configuration(request, region, metadata_cache=metadata_cache))
+
+    # Stopping with SIGTERM removes the socket like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return Daemon(socket_path(config), handle).serve()
+
+def _forward_to_daemon(args, config):
+    """
+    Runs a listing command in a running daemon of the same configuration. Returns None if it has to run here.
+    """
+    from minerva_cli.util.daemon import is_daemon_command, socket_path, forward
+
+    if args.no_daemon or not is_daemon_command(args):
+        return None
+    # The daemon uses the endpoint and credentials it was started with
+    if args.endpoint or args.region or args.client_id or args.profile:
+        return None
+    return forward(socket_path(config), sys.argv[1:])
+
 def main():
     args = parse_arguments()
+    # Log messages would otherwise be mixed with the JSON/CSV output
+    stream = sys.stderr if is_machine_readable(args.format) else sys.stdout
+    logging.basicConfig(stream=stream, level=logging.DEBUG if args.debug else logging.WARNING, format=FORMAT)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    if args.dryrun:
+        logger.info("DRY RUN")
+
     if args.command == "configure":
         return execute_command(args.command, None, None)
 
@@ -308,6 +594,17 @@ def main():
         logger.info("Run \"minerva configure\"")
         return -1
 
+    if args.command == "daemon" and args.stop:
+        from minerva_cli.util.daemon import socket_path, stop
+        if not stop(socket_path(config)):
+            logger.error("Daemon is not running")
+            return -1
+        return 0
+
+    status = _forward_to_daemon(args, config)
+    if status is not None:
+        return status
+
     username = None
     password = None
     endpoint = None
@@ -340,20 +637,54 @@ def main():
         [(username, "MINERVA_USERNAME"), (password, "MINERVA_PASSWORD"), (endpoint, "MINERVA_ENDPOINT"), (region, "MINERVA_REGION"),
          (client_id, "MINERVA_CLIENT_ID")])
 
-    client = create_minerva_client(endpoint=endpoint, region=region, client_id=client_id, username=username, password=password)
-    configuration = Configuration(repository=args.repository,
-                                  directory=args.dir,
-                                  file=args.file,
-                                  archive=args.archive,
-                                  image_name=args.imagename,
-                                  image_uuid=args.id,
-                                  output=args.output,
-                                  save_pyramid=args.pyramid,
-                                  dryrun=args.dryrun,
-                                  local_import=args.local,
-                                  export_format=args.format,
-                                  region=region)
-    status = execute_command(args.command, client, configuration)
+    from minerva_cli.util.tokencache import TokenCache
+
+    profiler = None
+    if args.profile:
+        from minerva_cli.util.profiler import Profiler
+        profiler = Profiler(args.profile, cprofile=args.cprofile)
+        profiler.start()
+
+    # Tokens are cached next to the config file, so that every invocation does not need to authenticate
+    token_cache = None if args.no_token_cache else TokenCache(os.path.join(os.path.dirname(config), ".minerva_tokens"))
+    client = create_minerva_client(endpoint=endpoint, region=region, client_id=client_id, username=username, password=password,
+                                   token_cache=token_cache)
+    if profiler is not None:
+        profiler.instrument_client(client)
+
+    if args.command == "daemon":
+        return run_daemon(args, config, client, region, username, password, token_cache)
+
+    transfer = None
+    if args.command in ("import", "export", "run"):
+        from minerva_cli.util.transfer import TransferScheduler
+        # One scheduler for all S3 transfers of the command, so that they share the bandwidth and concurrency
+        transfer = TransferScheduler(max_bandwidth=args.max_bandwidth, profiler=profiler)
+
+    metadata_cache = None
+    if not args.no_cache:
+        from minerva_cli.util.api import MetadataCache
+        metadata_cache = MetadataCache(os.path.join(os.path.dirname(config), ".minerva_cache"), ttl=args.cache_ttl)
+
+    import_index = None
+    if args.command in ("import", "run") and not args.reimport:
+        from minerva_cli.util.import_index import ImportIndex
+        import_index = ImportIndex(os.path.join(os.path.dirname(config), ".minerva_import_index"))
+
+    upload_state = None
+    if args.command in ("import", "run") and not args.local:
+        from minerva_cli.util.uploader import UploadState
+        upload_state = UploadState(os.path.join(os.path.dirname(config), ".minerva_uploads"))
+
+    configuration = create_configuration(args, region, profiler=profiler, metadata_cache=metadata_cache,
+                                         import_index=import_index, upload_state=upload_state, transfer=transfer)
+    try:
+        status = execute_command(args.command, client, configuration)
+    finally:
+        if transfer is not None and transfer.requests + transfer.failed > 0:
+            logger.info(transfer.report())
+        if profiler is not None:
+            profiler.save()
     return status
 
 
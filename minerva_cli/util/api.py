@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import requests
+
+from minerva_cli.util.configurer import Configurer
+from minerva_cli.util.tokencache import token_claims
+
+logger = logging.getLogger("minerva")
+
+# Query parameters used to request one page of a listing
+PAGE_SIZE_PARAMETER = "limit"
+PAGE_OFFSET_PARAMETER = "offset"
+
+
+def pool_connections(client, size):
+    """
+    Creates the client's HTTP session with a connection pool large enough for concurrent requests.
+    """
+    if client.session is None:
+        client.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    client.session.mount("https://", adapter)
+    client.session.mount("http://", adapter)
+
+
+def retry_unauthorized(client, login):
+    """
+    Calls login() and resends a request once when the API rejects the token with 401 Unauthorized,
+    e.g. because a cached token was revoked before it expired.
+    """
+    if client.session is None:
+        client.session = requests.Session()
+    client.session.hooks["response"].append(UnauthorizedRetry(client, login))
+
+
+class UnauthorizedRetry:
+    """
+    Response hook of retry_unauthorized. Requests of several threads which are rejected together log in
+    only once. The client is sent to local import workers with its session, so the hook is picklable
+    as long as login is, e.g. a functools.partial of a module-level function.
+    """
+
+    def __init__(self, client, login):
+        self.client = client
+        self.login = login
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"client": self.client, "login": self.login}
+
+    def __setstate__(self, state):
+        self.__init__(state["client"], state["login"])
+
+    def __call__(self, response, *args, **kwargs):
+        if response.status_code != 401 or getattr(response.request, "reauthenticated", False):
+            return response
+        rejected = response.request.headers.get("Authorization")
+        with self._lock:
+            if rejected == _authorization(self.client):
+                logger.info("The API rejected the token, logging in again")
+                self.login()
+        request = response.request.copy()
+        request.headers["Authorization"] = _authorization(self.client)
+        request.reauthenticated = True
+        return self.client.session.send(request, **kwargs)
+
+
+def _authorization(client):
+    return "{} {}".format(client.token_type, client.id_token)
+
+
+def iter_pages(client, path, page_size=500):
+    """
+    Yields the rows of a listing one page at a time. If the endpoint does not support
+    paging, the whole listing is returned as a single page.
+    """
+    offset = 0
+    previous = None
+    while True:
+        result = client.request('GET', path, parameters={PAGE_SIZE_PARAMETER: page_size, PAGE_OFFSET_PARAMETER: offset})
+        rows = result["data"]
+        # An endpoint which ignores the paging parameters returns the same rows again
+        if rows == previous:
+            return
+        yield rows
+        if len(rows) != page_size:
+            return
+        offset += len(rows)
+        previous = rows
+
+
+class MetadataCache:
+    """
+    On-disk cache of API responses. Cached responses younger than max_age are used as such,
+    older ones are revalidated with a conditional request using the ETag of the response.
+    Responses are cached per endpoint and user.
+    """
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+
+    def get(self, client, path, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        entries = self._load()
+        key = self._key(client, path)
+        entry = entries.get(key)
+        if entry is not None and time.time() - entry["time"] < max_age:
+            logger.debug("Using cached response for %s", path)
+            return entry["data"]
+
+        if client.session is None:
+            client.session = requests.Session()
+        headers = {"Authorization": client.token_type + " " + client.id_token}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        response = client.session.get(client.endpoint + path, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logger.debug("Cached response for %s is still valid", path)
+        else:
+            if response.status_code >= 400:
+                logger.error(response.text)
+            response.raise_for_status()
+            entry = {"etag": response.headers.get("ETag"), "data": response.json()}
+
+        entry["time"] = time.time()
+        entries[key] = entry
+        self._save(entries)
+        return entry["data"]
+
+    def find_repository(self, client, name):
+        """
+        Resolves a repository name into the repository. The cached repository list is revalidated
+        if the name is not found in it, e.g. when the repository was created after caching.
+        """
+        for max_age in (None, 0):
+            result = self.get(client, '/repository', max_age=max_age)
+            for repository in result["included"]["repositories"]:
+                if repository["name"] == name:
+                    return repository
+        return None
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring invalid metadata cache %s: %s", self.path, e)
+            return {}
+
+    def _save(self, entries):
+        # Written into a temporary file first, so that concurrent CLI processes never read a partial file
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        try:
+            with Configurer.open_private(tmp_path) as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not write metadata cache %s: %s", self.path, e)
+
+    @staticmethod
+    def _key(client, path):
+        claims = token_claims(client.id_token)
+        return "{}|{}|{}".format(client.endpoint, claims.get("sub"), path)
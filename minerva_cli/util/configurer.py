@@ -21,15 +21,24 @@ class Configurer:
         self.config["MINERVA_USERNAME"] = self.ask_value("Minerva username", required=False)
         self.config["MINERVA_PASSWORD"] = self.ask_password()
 
-        with open(config_path, "w") as config_file:
+        with Configurer.open_private(config_path) as config_file:
             config_file.write("[Minerva]\n")
             for key, value in self.config.items():
                 line = "{} = {}\n".format(key, value)
                 config_file.write(line)
 
-        os.chmod(config_path, stat.S_IRUSR | stat.S_IWUSR)
         print("Configuration done.")
 
+    @staticmethod
+    def open_private(path):
+        """
+        Opens a file for writing, readable and writable only by the current user.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR)
+        # os.open mode has no effect if the file already existed
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+        return os.fdopen(fd, "w")
+
     def ask_value(self, description, default="", required=True):
         value = None
         tries = 0
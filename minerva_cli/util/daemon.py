@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import contextlib
+import socketserver
+
+logger = logging.getLogger("minerva")
+
+# Commands which are forwarded to a running daemon. Imports and exports read and write local files,
+# show progress bars and start worker processes, so they always run in the calling process.
+DAEMON_COMMANDS = ["repositories", "images", "status"]
+SOCKET_NAME = ".minerva_daemon.sock"
+CONNECT_TIMEOUT = 1
+
+
+def is_daemon_command(args):
+    """
+    Whether the parsed command line can run in the daemon. Following the status runs until it is interrupted.
+    """
+    return args.command in DAEMON_COMMANDS and not (args.command == "status" and args.watch)
+
+
+def socket_path(config):
+    """
+    The socket is kept next to the config file, so that each configuration has its own daemon.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(config)), SOCKET_NAME)
+
+
+def forward(path, argv):
+    """
+    Runs a command in the daemon listening on path, writing its output, errors and log messages here.
+    Returns the exit status of the command, or None if no daemon is running.
+    """
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(CONNECT_TIMEOUT)
+        connection.connect(path)
+        connection.settimeout(None)
+    except OSError as e:
+        logger.debug("Daemon is not running (%s), running the command here", e)
+        connection.close()
+        return None
+
+    logger.debug("Forwarding command to daemon %s", path)
+    with connection, connection.makefile("rwb") as stream:
+        _send(stream, {"argv": argv})
+        for line in stream:
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            elif "log" in message:
+                logger.log(message["level"], message["log"])
+            elif "status" in message:
+                return message["status"]
+    logger.error("Daemon closed the connection")
+    return -1
+
+
+def stop(path):
+    """
+    Asks the daemon listening on path to stop. Returns False if no daemon is running.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        return False
+    with connection, connection.makefile("rwb") as stream:
+        _send(stream, {"stop": True})
+        stream.readline()
+    return True
+
+
+class Daemon:
+    """
+    Serves commands on a Unix socket, so that they run in a process which has already imported its
+    modules, authenticated and opened its connection pools. handle(argv) runs one command and returns
+    its exit status; it is called for one request at a time, with stdout, stderr and the minerva log
+    messages sent back to the calling process. The socket is readable only by the current user.
+    """
+
+    def __init__(self, path, handle):
+        self.path = path
+        self.handle = handle
+        self._lock = threading.Lock()
+        self._server = None
+
+    def serve(self):
+        """
+        Serves requests until the daemon is stopped. Returns -1 if another daemon is already listening.
+        """
+        if os.path.exists(self.path):
+            if _is_listening(self.path):
+                logger.error("A daemon is already listening on %s", self.path)
+                return -1
+            # Left behind by a daemon which was killed
+            os.remove(self.path)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.rfile, self.wfile)
+
+        previous_umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(previous_umask)
+        self._server.daemon_threads = True
+        logger.info("Daemon listening on %s", self.path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+            logger.info("Daemon stopped")
+        return 0
+
+    def _handle(self, rfile, wfile):
+        line = rfile.readline()
+        # Connections which send nothing only check whether the daemon is running
+        if not line:
+            return
+        request = json.loads(line)
+        if request.get("stop"):
+            _send(wfile, {"status": 0})
+            threading.Thread(target=self._server.shutdown).start()
+            return
+
+        output = _RemoteStream(wfile, "stdout")
+        errors = _RemoteStream(wfile, "stderr")
+        log_handler = _RemoteLogHandler(wfile, logging.DEBUG if "--debug" in request["argv"] else logging.INFO)
+        # Output is redirected for the whole process, so commands run one at a time
+        with self._lock:
+            level = logger.level
+            logger.setLevel(min(level, log_handler.level))
+            logger.addHandler(log_handler)
+            try:
+                with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+                    status = self.handle(request["argv"])
+            except SystemExit as e:
+                # e.g. argparse, whose usage and error message have been sent as stderr
+                status = e.code if isinstance(e.code, int) else -1
+            except BaseException as e:
+                logger.error("Command failed: %s", e)
+                status = -1
+            finally:
+                logger.removeHandler(log_handler)
+                logger.setLevel(level)
+                output.flush()
+                errors.flush()
+        _send(wfile, {"status": status})
+
+
+def _is_listening(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def _send(stream, message):
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+class _RemoteStream:
+    """
+    File-like object which sends the text written to it to the calling process when flushed,
+    where it is written to the stream of the same name.
+    """
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            _send(self.wfile, {self.name: "".join(self.buffer)})
+            self.buffer = []
+
+    def isatty(self):
+        return False
+
+
+class _RemoteLogHandler(logging.Handler):
+    """
+    Sends log messages to the calling process, which logs them with its own format and level.
+    Only messages of the thread serving the request are sent.
+    """
+
+    def __init__(self, wfile, level):
+        super().__init__(level)
+        self.wfile = wfile
+        self.thread = threading.get_ident()
+
+    def emit(self, record):
+        if record.thread != self.thread:
+            return
+        try:
+            _send(self.wfile, {"log": record.getMessage(), "level": record.levelno})
+        except OSError:
+            pass
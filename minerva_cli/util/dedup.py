@@ -0,0 +1,132 @@
+import hashlib
+import threading
+
+import numpy
+
+# Number of encoded constant tiles kept for reuse
+MAX_CONSTANT_TILES = 256
+
+
+# Encoded constant tiles of each encoder process, keyed by compressor, dtype, value and shape
+_constant_chunks = {}
+
+
+def init_encoder():
+    """
+    Initializes an encoder process. Blosc would start its own threads in the main thread of each encoder,
+    but the encoder processes already use the CPUs.
+    """
+    from numcodecs import blosc
+
+    blosc.use_threads = False
+
+
+def encode_tile(compressor, dtype, fill_value, chunk_shape, tile):
+    """
+    Encodes a tile into a zarr chunk, padded to the chunk shape like zarr does. Returns the encoded chunk,
+    or None if the tile is blank, i.e. contains only the fill value, and whether the tile is constant.
+    Runs in encoder processes, so it only takes picklable arguments instead of the zarr array.
+    """
+    value = tile.flat[0] if tile.size else fill_value
+    constant = tile.size == 0 or bool((tile == value).all())
+    if constant and value == fill_value:
+        return None, True
+
+    # Edge tiles are padded with the fill value, so only full constant tiles are encoded once
+    if constant and tile.shape == tuple(chunk_shape):
+        key = (repr(compressor), numpy.dtype(dtype).str, value.item(), tuple(chunk_shape))
+        data = _constant_chunks.get(key)
+        if data is None:
+            data = compressor.encode(numpy.full(chunk_shape, value, dtype=dtype))
+            if len(_constant_chunks) < MAX_CONSTANT_TILES:
+                _constant_chunks[key] = data
+        return data, True
+
+    if tile.shape != tuple(chunk_shape):
+        tile = numpy.pad(tile, ((0, chunk_shape[0] - tile.shape[0]), (0, chunk_shape[1] - tile.shape[1])),
+                         constant_values=fill_value)
+    return compressor.encode(numpy.ascontiguousarray(tile, dtype=dtype)), constant
+
+
+class TileDeduplicator:
+    """
+    Counts the tiles of an import which do not need to be stored or encoded again. Blank tiles, which only
+    contain the fill value of the array, are not stored at all, because a missing chunk reads as the fill value.
+    Constant tiles are encoded once per value (see encode_tile). Encoded chunks are hashed to count repeated
+    tiles; these still have to be stored, zarr has one object per chunk. Tiles are counted from several
+    upload threads, so the counters are guarded by a lock.
+    """
+
+    def __init__(self):
+        self.tiles = 0
+        self.blank = 0
+        self.constant = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.duplicate_bytes = 0
+        self._hashes = set()
+        self._blank_chunks = {}
+        self._lock = threading.Lock()
+
+    def is_blank_chunk(self, arr, data):
+        """
+        Whether an already encoded chunk is the encoded blank chunk of the array.
+        """
+        with self._lock:
+            blank = self._blank_chunks.get(arr.path)
+        if blank is None:
+            blank = bytes(arr.compressor.encode(numpy.full(arr.chunks[-2:], arr.fill_value, dtype=arr.dtype)))
+            with self._lock:
+                self._blank_chunks[arr.path] = blank
+        return len(data) == len(blank) and bytes(data) == blank
+
+    def count(self, data, constant=False):
+        """
+        Counts an encoded chunk, or a blank tile if data is None.
+        """
+        digest = hashlib.blake2b(data, digest_size=16).digest() if data is not None else None
+        with self._lock:
+            self.tiles += 1
+            if data is None:
+                self.blank += 1
+                return
+            self.constant += int(constant)
+            self.bytes += len(data)
+            if digest in self._hashes:
+                self.duplicates += 1
+                self.duplicate_bytes += len(data)
+            else:
+                self._hashes.add(digest)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "tiles": self.tiles,
+                "blank": self.blank,
+                "constant": self.constant,
+                "duplicates": self.duplicates,
+                "unique": self.tiles - self.blank - self.duplicates,
+                "bytes": self.bytes,
+                "duplicate bytes": self.duplicate_bytes
+            }
+
+
+def merge_summaries(summaries):
+    total = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def report(summary):
+    """
+    Describes how many tiles were skipped as blank, and how many could be deduplicated by content.
+    """
+    tiles = max(summary.get("tiles", 0), 1)
+    return ("Tiles: {} blank (not uploaded, {:.1f}%), {} constant, {} duplicates ({:.1f}%, {:.1f} MB); "
+            "unique tiles {:.1f}%, {:.1f} MB uploaded"
+            .format(summary.get("blank", 0), 100 * summary.get("blank", 0) / tiles, summary.get("constant", 0),
+                    summary.get("duplicates", 0), 100 * summary.get("duplicates", 0) / tiles,
+                    summary.get("duplicate bytes", 0) / 1e6, 100 * summary.get("unique", 0) / tiles,
+                    summary.get("bytes", 0) / 1e6))
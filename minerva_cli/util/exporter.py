@@ -0,0 +1,576 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numcodecs
+import numpy
+import zarr
+import tifffile
+from minerva_lib.exporting import MinervaExporter, SOFTWARE_TAG_CODE
+
+from minerva_cli.util.profiler import stage
+from minerva_cli.util.selection import ExportSelection, subset_ome_metadata
+from minerva_cli.util.transfer import run, botocore_config
+
+logger = logging.getLogger("minerva")
+
+TILE_PATTERN = "C\\d+-T\\d+-Z\\d+-L\\d+-Y\\d+-X\\d+\\.png"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# TIFF compression tags of the export compressions, tiles are encoded with the same codecs as zarr chunks
+TIFF_COMPRESSION_TAGS = {"zstd": 50000, "deflate": 8}
+
+
+class ExportManifest:
+    """
+    Checkpoint of the objects which have been completely downloaded into the export directory.
+    Each completed object is appended as one JSON line, so that an interrupted export
+    keeps everything that was written before the interruption. The checkpoint is removed
+    when the export is complete.
+    """
+    FILENAME = ".minerva-export.jsonl"
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, ExportManifest.FILENAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+                    except ValueError:
+                        # The last line may be incomplete if the process was killed while writing it
+                        logger.debug("Ignoring invalid manifest line: %s", line)
+
+    def is_complete(self, obj, path):
+        entry = self.entries.get(obj["Key"])
+        if entry is None or entry["size"] != obj["Size"] or entry["etag"] != obj["ETag"]:
+            return False
+        return os.path.isfile(path) and os.path.getsize(path) == obj["Size"]
+
+    def add(self, obj):
+        entry = {"key": obj["Key"], "size": obj["Size"], "etag": obj["ETag"]}
+        with self._lock:
+            self.entries[obj["Key"]] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def remove(self):
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+
+class TileDownloader:
+    """
+    Downloads image objects concurrently with a pooled S3 client. Objects are scheduled in the
+    order in which the OME-TIFF writer consumes them, and scheduling does not run more than
+    prefetch_levels pyramid levels ahead of the level being written. The writer waits for
+    each tile separately, so tiles stream from the download into the writer.
+    """
+
+    def __init__(self, s3, bucket, directory, manifest, concurrency=10, prefetch_levels=None, progress_callback=lambda a, b: None,
+                 profiler=None, transfer=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.directory = directory
+        self.manifest = manifest
+        self.concurrency = concurrency
+        self.prefetch_levels = prefetch_levels
+        self.progress_callback = progress_callback
+        self.profiler = profiler
+        self.transfer = transfer
+        self.events = {}
+        self.error = None
+        self.total = 0
+        self.processed = 0
+        self.writing_level = 0
+        self.stats = TransferStats()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self, objs):
+        objs = sorted(objs, key=_object_order)
+        missing = []
+        for obj in objs:
+            path = os.path.join(self.directory, obj["Key"])
+            if self.manifest.is_complete(obj, path):
+                continue
+            if os.path.isfile(path) and _verify(obj, path, checksum=True):
+                self.manifest.add(obj)
+                continue
+            missing.append(obj)
+            self.events[obj["Key"]] = threading.Event()
+
+        self.total = len(objs)
+        self.processed = self.total - len(missing)
+        if self.processed > 0:
+            logger.info("Resuming export, %s of %s objects already downloaded", self.processed, self.total)
+        self.progress_callback(self.processed, self.total)
+
+        self._thread = threading.Thread(target=self._schedule, args=(missing,), daemon=True)
+        self._thread.start()
+
+    def wait(self, key):
+        """
+        Blocks until the object has been downloaded. Objects which were complete already,
+        or which do not exist in S3 (e.g. empty zarr chunks), return immediately.
+        """
+        event = self.events.get(key)
+        if event is not None and not event.is_set():
+            with stage(self.profiler, "wait tile"):
+                event.wait()
+        if self.error is not None:
+            raise self.error
+
+    def set_writing_level(self, level):
+        with self._condition:
+            self.writing_level = level
+            self._condition.notify_all()
+
+    def join(self):
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        self.stats.stop()
+
+    def _schedule(self, objs):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for obj in objs:
+                # Only tiles are held back, zarr metadata is always downloaded first
+                order = _object_order(obj)
+                level = order[1] if order[0] == 1 else None
+                with self._condition:
+                    while (self.prefetch_levels is not None and level is not None and self.error is None
+                           and level > self.writing_level + self.prefetch_levels):
+                        self._condition.wait()
+                if self.error is not None:
+                    break
+                executor.submit(self._download, obj)
+
+        # Release any waiters if the download was aborted
+        for event in self.events.values():
+            event.set()
+
+    def _download(self, obj):
+        try:
+            path = os.path.join(self.directory, obj["Key"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            logger.debug("Downloading key %s", obj["Key"])
+            with stage(self.profiler, "download", obj["Size"]):
+                body = run(self.transfer, lambda: self.s3.get_object(Bucket=self.bucket, Key=obj["Key"])["Body"].read(),
+                           obj["Size"])
+            # Write into a temporary file first, so that an interrupted download never
+            # leaves a truncated object behind
+            with stage(self.profiler, "save tile", len(body)):
+                with open(path + ".part", "wb") as f:
+                    f.write(body)
+                os.replace(path + ".part", path)
+                if not _verify(obj, path):
+                    raise IOError("Downloaded object {} is corrupt".format(obj["Key"]))
+            self.manifest.add(obj)
+            with self._condition:
+                self.processed += 1
+                self.stats.add(len(body))
+                self.progress_callback(self.processed, self.total)
+        except Exception as e:
+            with self._condition:
+                if self.error is None:
+                    self.error = e
+                self._condition.notify_all()
+        finally:
+            self.events[obj["Key"]].set()
+
+
+class TransferStats:
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+
+    def add(self, num_bytes):
+        self.objects += 1
+        self.bytes += num_bytes
+
+    def stop(self):
+        self.end = time.time()
+
+    def report(self):
+        elapsed = max((self.end or time.time()) - self.start, 1e-6)
+        return "Downloaded {} tiles ({:.1f} MB) in {:.1f} s: {:.1f} tiles/s, {:.2f} MB/s".format(
+            self.objects, self.bytes / 1e6, elapsed, self.objects / elapsed, self.bytes / 1e6 / elapsed)
+
+
+class TileExporter(MinervaExporter):
+    """
+    Exporter which downloads the image objects from S3 tile bucket into a local directory,
+    and skips the objects which have already been downloaded by a previous, interrupted run.
+    OME-TIFFs are written from the local copy while the tiles are being downloaded.
+
+    Tiles are read and encoded by writer_threads threads. compression (one of EXPORT_COMPRESSIONS)
+    and tile_size set the codec and tile size of the output; by default OME-TIFFs are uncompressed,
+    and zarr exports are copies of the objects in the tile bucket. Downloads go through the
+    TransferScheduler transfer, if one is given.
+    """
+
+    def __init__(self, region, concurrency=10, prefetch_levels=1, profiler=None, compression=None, tile_size=None,
+                 writer_threads=None, transfer=None):
+        super().__init__(region)
+        self.transfer = transfer
+        self.concurrency = concurrency
+        self.prefetch_levels = prefetch_levels
+        self.profiler = profiler
+        self.compression = compression
+        self.tile_size = tile_size
+        self.writer_threads = writer_threads or os.cpu_count() or 1
+        self.stats = None
+
+    def export_image(self, minerva_client, image_uuid, output_path, save_pyramid=False, progress_callback=lambda a, b: None, format="zarr",
+                     selection=None):
+        """
+        Exports the image, or only the part of it given by an ExportSelection. Only the tiles
+        overlapping the selection are downloaded. Zarr exports keep the layout of the tile bucket,
+        with the tiles outside of the selection left out.
+        """
+        image, ome_metadata = self._get_image_and_metadata(minerva_client, image_uuid)
+        if image is None:
+            raise KeyError(image_uuid)
+        logger.debug(ome_metadata)
+
+        selection = selection or ExportSelection()
+        image_info = image["included"]["images"][0]
+        pyramid_levels = image_info["pyramid_levels"]
+        pixels = image["data"]["pixels"]
+        selection.validate(len(pixels["channels"]), pixels["SizeY"], pixels["SizeX"], pyramid_levels,
+                           pixels.get("SizeT", 1), pixels.get("SizeZ", 1))
+        levels = pyramid_levels if save_pyramid else selection.level + 1
+        tile_size = image_info.get("tile_size", 1024)
+
+        if format == "zarr":
+            directory = output_path or "."
+            if self.compression is None and self.tile_size is None:
+                downloader = self.download_objects(minerva_client, image_uuid, directory,
+                                                   levels=levels if selection.is_subset() else None,
+                                                   progress_callback=progress_callback, selection=selection, tile_size=tile_size)
+                downloader.join()
+                downloader.manifest.remove()
+                return os.path.join(directory, image_uuid)
+
+            # Chunks are downloaded next to the output, and encoded again when the download is complete
+            cache_directory = os.path.join(directory, image_uuid + ".cache")
+            downloader = self.download_objects(minerva_client, image_uuid, cache_directory,
+                                               levels=levels if selection.is_subset() else None,
+                                               progress_callback=progress_callback, selection=selection, tile_size=tile_size)
+            downloader.join()
+            output = os.path.join(directory, image_uuid)
+            self.write_zarr(os.path.join(cache_directory, image_uuid), output)
+            shutil.rmtree(cache_directory)
+            return output
+
+        # Unsupported compressions fail before anything is downloaded
+        _tiff_codec(self.compression)
+        if output_path is None:
+            output_path = self._default_tiff_name(image)
+
+        # Tiles are downloaded next to the output file, and removed when the OME-TIFF is complete
+        cache_directory = output_path + ".cache"
+        downloader = self.download_objects(minerva_client, image_uuid, cache_directory, levels=levels,
+                                           prefetch_levels=self.prefetch_levels, progress_callback=progress_callback,
+                                           selection=selection, tile_size=tile_size)
+        self.write_ometiff(os.path.join(cache_directory, image_uuid), ome_metadata, output_path, levels, downloader=downloader,
+                           selection=selection)
+        downloader.join()
+        shutil.rmtree(cache_directory)
+        return output_path
+
+    def download_objects(self, minerva_client, image_uuid, directory, levels=None, prefetch_levels=None, progress_callback=lambda a, b: None,
+                         selection=None, tile_size=1024):
+        """
+        Starts downloading the objects of the image into directory, skipping objects which are already complete.
+        If levels is given, only the pyramid levels below it are downloaded, and if selection is given,
+        only the tiles it includes. Returns the running TileDownloader.
+        """
+        credentials, bucket, prefix = minerva_client.get_image_credentials(image_uuid)
+        # One client shared by all download threads, with a connection pool large enough for all of them
+        s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
+                          aws_secret_access_key=credentials["SecretAccessKey"],
+                          aws_session_token=credentials["SessionToken"],
+                          region_name=self.region,
+                          config=botocore_config(self.transfer, max_pool_connections=self.concurrency))
+
+        objs = [obj for obj in self._list_objects(s3, bucket, image_uuid)
+                if _in_levels(obj["Key"], levels) and _in_selection(obj["Key"], selection, tile_size)]
+        if selection is not None and selection.is_subset():
+            logger.info("Downloading %s objects of the selected part of the image", len(objs))
+        os.makedirs(directory, exist_ok=True)
+        downloader = TileDownloader(s3, bucket, directory, ExportManifest(directory),
+                                    concurrency=self.concurrency,
+                                    prefetch_levels=prefetch_levels,
+                                    progress_callback=progress_callback,
+                                    profiler=self.profiler,
+                                    transfer=self.transfer)
+        self.stats = downloader.stats
+        downloader.start(objs)
+        return downloader
+
+    def write_ometiff(self, zarr_path, ome_metadata, output_path, levels, downloader=None, selection=None):
+        """
+        Assembles an OME-TIFF from a zarr image on local disk. If a downloader is given,
+        each tile is written as soon as it has been downloaded. If a selection is given,
+        only the selected part of the image is written, starting from the selected level.
+        """
+        selection = selection or ExportSelection()
+        codec = _tiff_codec(self.compression)
+        compression = TIFF_COMPRESSION_TAGS[self.compression] if codec is not None else None
+        if self.tile_size is not None and self.tile_size % 16 != 0:
+            raise ValueError("TIFF tile size must be a multiple of 16: {}".format(self.tile_size))
+
+        image_uuid = os.path.basename(zarr_path)
+        wait = downloader.wait if downloader is not None else lambda key: None
+        wait(image_uuid + "/.zgroup")
+        group = zarr.open_group(zarr_path, mode="r")
+        extra_tags = [(SOFTWARE_TAG_CODE, "s", 1, "Minerva (Glencoe/Faas pyramid output)", True)]
+        with tifffile.TiffWriter(output_path, bigtiff=True) as tif, \
+                ThreadPoolExecutor(max_workers=self.writer_threads) as executor:
+            for level in range(selection.level, levels):
+                if downloader is not None:
+                    downloader.set_writing_level(level)
+                wait("{}/{}/.zarray".format(image_uuid, level))
+                arr = group[str(level)]
+                channels = selection.selected_channels(arr.shape[1])
+                region = selection.level_region(level, arr.shape[3], arr.shape[4])
+                height, width = region[1] - region[0], region[3] - region[2]
+                tile_size = self.tile_size or arr.chunks[4]
+                if level == selection.level and selection.is_subset():
+                    ome_metadata = subset_ome_metadata(ome_metadata, channels, height, width, level)
+                logger.debug("Pyramid level %s/%s", level, levels - 1)
+                for index, channel in enumerate(channels):
+                    subfiletype = 0 if (level == selection.level) else 1
+                    # Write metadata to first page only
+                    description = ome_metadata if (index == 0 and level == selection.level) else None
+                    chunk_key = "{}/{}/{}.{}.{}.{{}}.{{}}".format(image_uuid, level, selection.timepoint, channel, selection.z)
+                    tasks = _tile_tasks(arr, channel, tile_size, lambda y, x: wait(chunk_key.format(y, x)), self.profiler,
+                                        region=region, timepoint=selection.timepoint, z=selection.z, codec=codec)
+                    # Includes waiting for, reading and encoding the tiles, which are recorded as stages of their own
+                    with stage(self.profiler, "write tiff page", level=level, channel=channel):
+                        tif.write(_in_order(tasks, executor, 2 * self.writer_threads),
+                                  shape=(height, width),
+                                  dtype=arr.dtype,
+                                  tile=(tile_size, tile_size),
+                                  compression=compression,
+                                  metadata=None,
+                                  subfiletype=subfiletype,
+                                  description=description,
+                                  extratags=extra_tags)
+
+        logger.debug("Image file: %s", output_path)
+
+    def write_zarr(self, source_path, output_path):
+        """
+        Copies a zarr image on local disk into output_path with the compression and tile size of the exporter.
+        Chunks are encoded in parallel, and chunks which only contain the fill value, e.g. because they do not
+        exist in the source, are left out.
+        """
+        compressor = _zarr_compressor(self.compression)
+        source = zarr.open_group(source_path, mode="r")
+        output = zarr.open_group(output_path, mode="w")
+        output.attrs.update(source.attrs)
+        levels = sorted((name for name in source.array_keys() if name.isdigit()), key=int)
+        with ThreadPoolExecutor(max_workers=self.writer_threads) as executor:
+            for name in levels:
+                arr = source[name]
+                tile_size = self.tile_size or arr.chunks[4]
+                out = output.create(name, shape=arr.shape, chunks=arr.chunks[:3] + (tile_size, tile_size), dtype=arr.dtype,
+                                    compressor=compressor if self.compression is not None else arr.compressor,
+                                    fill_value=arr.fill_value)
+                tasks = [(t, c, z, y, x) for t in range(arr.shape[0]) for c in range(arr.shape[1])
+                         for z in range(arr.shape[2])
+                         for y in range(0, arr.shape[3], tile_size) for x in range(0, arr.shape[4], tile_size)]
+                for _ in executor.map(lambda task: self._copy_chunk(arr, out, tile_size, *task), tasks):
+                    pass
+
+        metadata_path = os.path.join(source_path, "metadata.xml")
+        if os.path.isfile(metadata_path):
+            shutil.copyfile(metadata_path, os.path.join(output_path, "metadata.xml"))
+        logger.debug("Image directory: %s", output_path)
+
+    def _copy_chunk(self, source, output, tile_size, t, c, z, y, x):
+        with stage(self.profiler, "read tile"):
+            tile = source[t, c, z, y:y + tile_size, x:x + tile_size]
+        # A chunk which is not written reads as the fill value, zarr 2.6 would still write it
+        if output.fill_value is not None and (tile == output.fill_value).all():
+            return
+        # Writes cover whole chunks, so that no chunk is written by two threads
+        with stage(self.profiler, "encode tile", tile.nbytes):
+            output[t, c, z, y:y + tile_size, x:x + tile_size] = tile
+
+    def _list_objects(self, s3, bucket, prefix):
+        objs = []
+        args = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": 10000}
+        while True:
+            result = run(self.transfer, lambda: s3.list_objects_v2(**args))
+            objs.extend(result.get("Contents", []))
+            if not result["IsTruncated"]:
+                return objs
+            args["ContinuationToken"] = result["NextContinuationToken"]
+
+    def _default_tiff_name(self, image):
+        output_path = image["included"]["images"][0]["name"]
+        if output_path.endswith(".ome"):
+            output_path += ".tif"
+        elif not output_path.endswith(".ome.tif"):
+            output_path += ".ome.tif"
+        return output_path
+
+
+def _tile_tasks(arr, channel, tile_size, wait, profiler=None, region=None, timepoint=0, z=0, codec=None):
+    """
+    Returns functions which read, and if codec is given encode, the tiles of a TIFF page
+    in the row-major order expected by TiffWriter. Tiles of a region which does not
+    start at a tile boundary, or whose tile size differs from the chunk size, are
+    assembled from the chunks they overlap.
+    """
+    y0, y1, x0, x1 = region if region is not None else (0, arr.shape[3], 0, arr.shape[4])
+    chunk_height, chunk_width = arr.chunks[3], arr.chunks[4]
+
+    def read(y, x):
+        y_end = min(y + tile_size, y1)
+        x_end = min(x + tile_size, x1)
+        for chunk_y in range(y // chunk_height, (y_end - 1) // chunk_height + 1):
+            for chunk_x in range(x // chunk_width, (x_end - 1) // chunk_width + 1):
+                wait(chunk_y, chunk_x)
+        with stage(profiler, "read tile"):
+            tile = arr[timepoint, channel, z, y:y_end, x:x_end]
+        if codec is None:
+            return tile
+        # Encoded tiles are written as they are, so edge tiles are padded here
+        if tile.shape != (tile_size, tile_size):
+            tile = numpy.pad(tile, ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])))
+        with stage(profiler, "encode tile", tile.nbytes):
+            return codec.encode(numpy.ascontiguousarray(tile))
+
+    return [lambda y=y, x=x: read(y, x) for y in range(y0, y1, tile_size) for x in range(x0, x1, tile_size)]
+
+
+def _in_order(tasks, executor, lookahead):
+    # Runs up to lookahead tasks ahead of the consumer, so that only a few tiles are held in memory
+    pending = deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(executor.submit(task))
+        if len(pending) >= lookahead:
+            break
+    while pending:
+        result = pending.popleft().result()
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(executor.submit(task))
+        yield result
+
+
+def _tiff_codec(compression):
+    if compression is None or compression == "none":
+        return None
+    if compression == "zstd":
+        return numcodecs.Zstd(level=3)
+    if compression == "deflate":
+        # TIFF Adobe deflate tiles are zlib streams
+        return numcodecs.Zlib(level=6)
+    raise ValueError("{} compression is not supported for OME-TIFF, use zstd or deflate".format(compression))
+
+
+def _zarr_compressor(compression):
+    if compression is None or compression == "none":
+        return None
+    if compression == "deflate":
+        return numcodecs.Zlib(level=6)
+    # Same settings as the tile bucket
+    return zarr.Blosc(cname=compression, clevel=3)
+
+
+def _object_order(obj):
+    """
+    Sort key which puts zarr metadata first, and then the tiles in the order
+    they are written: level, channel, row, column.
+    """
+    indices = _tile_indices(obj["Key"])
+    if indices is None:
+        level = _key_level(obj["Key"])
+        return (0, -1 if level is None else level, 0, 0, 0)
+    level, c, t, z, y, x = indices
+    return (1, level, c, y, x)
+
+
+def _tile_indices(key):
+    """
+    Returns the indices (level, channel, timepoint, z, y, x) of a zarr chunk ("uuid/2/0.1.0.3.4")
+    or of a PNG tile ("uuid/C1-T0-Z0-L2-Y3-X4.png"), or None for other objects.
+    """
+    name = os.path.basename(key)
+    if re.fullmatch(TILE_PATTERN, name):
+        c, t, z, level, y, x = [int(i) for i in re.findall("\\d+", name)]
+        return level, c, t, z, y, x
+    level = _key_level(key)
+    if level is None or name.startswith("."):
+        return None
+    index = [int(i) for i in name.split(".")] + [0] * 5
+    return level, index[1], index[0], index[2], index[3], index[4]
+
+
+def _key_level(key):
+    """
+    Returns the pyramid level of a zarr chunk ("uuid/2/0.0.0.0.0") or of a
+    PNG tile ("uuid/C0-T0-Z0-L2-Y0-X0.png"), or None for other objects.
+    """
+    name = os.path.basename(key)
+    if re.fullmatch(TILE_PATTERN, name):
+        return int(re.search("-L(\\d+)-", name).group(1))
+    parts = key.split("/")
+    if len(parts) >= 3 and parts[-2].isdigit():
+        return int(parts[-2])
+    return None
+
+
+def _in_levels(key, levels):
+    level = _key_level(key)
+    return levels is None or level is None or level < levels
+
+
+def _in_selection(key, selection, tile_size):
+    # Zarr and OME metadata are always needed
+    indices = _tile_indices(key)
+    return selection is None or indices is None or selection.includes_tile(*indices, tile_size)
+
+
+def _verify(obj, path, checksum=False):
+    """
+    Checks that a file on disk matches the S3 object: size, PNG signature for tiles and,
+    if checksum is set, the MD5 checksum when the ETag is a plain MD5 (not a multipart upload).
+    """
+    if os.path.getsize(path) != obj["Size"]:
+        return False
+
+    if re.fullmatch(TILE_PATTERN, os.path.basename(path)):
+        with open(path, "rb") as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return False
+
+    etag = obj["ETag"].strip('"')
+    if not checksum or "-" in etag:
+        return True
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest() == etag
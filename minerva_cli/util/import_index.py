@@ -0,0 +1,211 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("minerva")
+
+# Files of a directory image which describe its groups and arrays, e.g. .zarray and OME/METADATA.ome.xml
+DIRECTORY_METADATA = [".zgroup", ".zattrs", ".zarray", ".zmetadata", ".xml"]
+
+
+class ScannedFile:
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.hash = None
+
+
+def scan_files(directory, filefilter, workers=16, dirfilter=()):
+    """
+    Lists the files in directory and its subdirectories whose extension is in filefilter.
+    Directories whose extension is in dirfilter (e.g. .zarr) are listed as single files
+    instead of being scanned. Directories are scanned in parallel, because on network
+    filesystems each directory listing and stat call is a round trip to the server.
+    """
+    files = []
+    lock = threading.Lock()
+    pending = []
+
+    def scan(path):
+        subdirectories = []
+        found = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=True):
+                        if os.path.splitext(entry.name)[1] in dirfilter:
+                            found.append(scan_file(entry.path))
+                        elif not entry.is_symlink():
+                            # Like os.walk, links to directories are not followed, they may point to an ancestor
+                            subdirectories.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in filefilter:
+                        stat = entry.stat()
+                        found.append(ScannedFile(entry.path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            logger.warning("Could not scan %s: %s", path, e)
+
+        with lock:
+            files.extend(found)
+            pending.extend(executor.submit(scan, subdirectory) for subdirectory in subdirectories)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending.append(executor.submit(scan, directory))
+        # Futures of subdirectories are added while scanning, so wait until no more appear
+        while True:
+            with lock:
+                if not pending:
+                    break
+                future = pending.pop()
+            future.result()
+
+    files.sort(key=lambda f: f.path)
+    logger.debug("Found %s files in %s", len(files), directory)
+    return files
+
+
+def scan_file(path):
+    """
+    A directory image (e.g. OME-zarr) gets the total size and the latest modification time of its metadata files
+    and of the directories of its groups and arrays, whose modification time changes when chunks are added or removed.
+    The chunks are not listed, an image has up to millions of them; with --hash their content is compared instead.
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return ScannedFile(path, stat.st_size, stat.st_mtime)
+
+    size = 0
+    mtime = 0
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        mtime = max(mtime, os.stat(directory).st_mtime)
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+        # Subdirectories of an array hold only chunks
+        is_array = any(entry.name == ".zarray" for entry in entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not is_array:
+                    directories.append(entry.path)
+            elif os.path.splitext(entry.name)[1] in DIRECTORY_METADATA or entry.name in DIRECTORY_METADATA:
+                stat = entry.stat()
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+    return ScannedFile(path, size, mtime)
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    files = _walk_files(path) if os.path.isdir(path) else [path]
+    for file in files:
+        if file != path:
+            # Renaming a file inside a directory image changes its content
+            sha.update(os.path.relpath(file, path).encode("utf-8"))
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def _walk_files(directory):
+    files = []
+    for root, subdirectories, names in os.walk(directory):
+        subdirectories.sort()
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    return files
+
+
+class ImportIndex:
+    """
+    Index of files which have been imported, keyed by repository and absolute path.
+    A file is considered imported if its size and modification time have not changed,
+    or, when content hashes are used, if its content hash has not changed.
+    Each imported file is appended as one JSON line, and lines replaced by a later import
+    of the same file are removed when the index is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # Jobs of a manifest add files from several threads
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            lines = 0
+            with open(path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        self.entries[(entry["repository"], entry["path"])] = entry
+                    except ValueError:
+                        logger.debug("Ignoring invalid import index line: %s", line)
+            if lines > len(self.entries):
+                self._compact()
+
+    def __getstate__(self):
+        # The configuration, and with it the index, is sent to the local import workers
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _compact(self):
+        # Written into a temporary file first, so that concurrent CLI processes never read a partial file
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not compact import index %s: %s", self.path, e)
+
+    def filter_new(self, repository, files, use_hash=False, workers=16):
+        """
+        Returns the files which have not been imported into the repository, or which have changed since.
+        """
+        candidates = []
+        new_files = []
+        for file in files:
+            entry = self.entries.get((repository, os.path.abspath(file.path)))
+            if entry is None or entry["size"] != file.size:
+                new_files.append(file)
+            elif use_hash:
+                candidates.append((file, entry))
+            elif entry["mtime"] != file.mtime:
+                new_files.append(file)
+
+        # Files with unchanged size are hashed to detect changed content, or unchanged content with a new mtime
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(lambda candidate: hash_file(candidate[0].path), candidates)
+            for (file, entry), digest in zip(candidates, hashes):
+                file.hash = digest
+                if entry.get("hash") != digest:
+                    new_files.append(file)
+
+        new_files.sort(key=lambda f: f.path)
+        return new_files
+
+    def add(self, repository, files, use_hash=False):
+        for file in files:
+            if use_hash and file.hash is None:
+                file.hash = hash_file(file.path)
+        with self._lock, open(self.path, "a") as f:
+            for file in files:
+                entry = {
+                    "repository": repository,
+                    "path": os.path.abspath(file.path),
+                    "size": file.size,
+                    "mtime": file.mtime,
+                    "hash": file.hash
+                }
+                self.entries[(repository, entry["path"])] = entry
+                f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,265 @@
+import os
+import sys
+import csv
+import copy
+import json
+import time
+import logging
+import threading
+from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+
+from minerva_lib.util.fileutils import FileUtils
+
+from minerva_cli.util.units import parse_size
+from minerva_cli.util.selection import parse_indices, parse_roi
+from minerva_cli.util.output import EXPORT_FORMATS
+
+logger = logging.getLogger("minerva")
+
+JOB_COMMANDS = ["import", "export"]
+DEFAULT_JOB_CONCURRENCY = 4
+DEFAULT_JOB_RETRIES = 2
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ("1", "true", "yes", "y"):
+        return True
+    if value in ("", "0", "false", "no", "n"):
+        return False
+    raise ValueError("Invalid boolean: {}".format(value))
+
+
+# Manifest columns are named like the command line options, and map to Configuration attributes
+MANIFEST_FIELDS = {
+    "repository": ("repository", str),
+    "file": ("file", str),
+    "dir": ("directory", str),
+    "id": ("image_uuid", str),
+    "output": ("output", str),
+    "format": ("export_format", str),
+    "imagename": ("image_name", str),
+    "pyramid": ("save_pyramid", _parse_bool),
+    "local": ("local_import", _parse_bool),
+    "workers": ("workers", int),
+    "max_memory": ("max_memory", parse_size),
+    "upload_concurrency": ("upload_concurrency", int),
+    "encoders": ("encoders", int),
+    "hash": ("use_hash", _parse_bool),
+    "archive": ("archive", _parse_bool),
+    "concurrency": ("concurrency", int),
+    "channels": ("channels", parse_indices),
+    "level": ("level", int),
+    "roi": ("roi", parse_roi),
+    "timepoint": ("timepoint", int),
+    "z": ("z", int),
+    "compression": ("compression", str),
+    "tile_size": ("tile_size", int),
+    "writer_threads": ("writer_threads", int),
+}
+
+
+class Job:
+
+    def __init__(self, number, command, cfg):
+        self.number = number
+        self.command = command
+        self.cfg = cfg
+
+    @property
+    def target(self):
+        if self.command == "export":
+            return self.cfg.image_uuid
+        return self.cfg.file or self.cfg.directory
+
+
+def load_manifest(path, cfg):
+    """
+    Reads jobs from a CSV or YAML manifest. Each row or list item has a command (import or export)
+    and options named like the command line options, e.g. repository, dir, id, format, pyramid.
+    Options which are not given are taken from cfg, i.e. from the command line.
+    A YAML manifest is either a list of jobs, or a mapping with "defaults" and "jobs".
+    """
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Reading YAML manifests requires PyYAML (pip install pyyaml)")
+        with open(path) as f:
+            document = yaml.safe_load(f) or []
+        defaults = {}
+        if isinstance(document, dict):
+            defaults = document.get("defaults") or {}
+            document = document.get("jobs") or []
+        rows = [dict(defaults, **row) for row in document]
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(row for row in f if row.strip() and not row.lstrip().startswith("#")))
+
+    return [_create_job(number, row, cfg) for number, row in enumerate(rows, start=1)]
+
+
+def _create_job(number, row, cfg):
+    options = {_normalize(key): value for key, value in row.items() if key is not None}
+    command = str(options.pop("command", "") or "").strip().lower()
+    if command not in JOB_COMMANDS:
+        raise ValueError("Job {}: command must be one of {}".format(number, ", ".join(JOB_COMMANDS)))
+
+    job_cfg = copy.copy(cfg)
+    for key, value in options.items():
+        if value is None or value == "":
+            continue
+        if key not in MANIFEST_FIELDS:
+            raise ValueError("Job {}: unknown option {}".format(number, key))
+        attribute, parse = MANIFEST_FIELDS[key]
+        try:
+            setattr(job_cfg, attribute, parse(value))
+        except ValueError as e:
+            raise ValueError("Job {}: {}".format(number, e))
+
+    # Jobs run at the same time, and stdout is kept for the job results of run
+    job_cfg.output_stream = sys.stderr
+    if command == "import":
+        job_cfg.file = job_cfg.file or ""
+        job_cfg.directory = job_cfg.directory or ""
+    try:
+        _validate(command, job_cfg)
+    except ValueError as e:
+        raise ValueError("Job {}: {}".format(number, e))
+    return Job(number, command, job_cfg)
+
+
+def _validate(command, cfg):
+    """
+    Checks the options of a job before any job runs or any repository is created,
+    so that a mistake in the manifest does not leave a run half done.
+    """
+    if command == "import":
+        if not cfg.repository:
+            raise ValueError("repository is missing")
+        FileUtils.validate_name(cfg.repository, "Repository")
+        if not cfg.file and not cfg.directory:
+            raise ValueError("give either file or dir to import")
+    else:
+        if not cfg.image_uuid:
+            raise ValueError("id of the image to export is missing")
+        try:
+            UUID(cfg.image_uuid, version=4)
+        except ValueError:
+            raise ValueError("{} is not a valid UUID".format(cfg.image_uuid))
+        if cfg.export_format not in EXPORT_FORMATS + [None]:
+            raise ValueError("format must be one of {}".format(", ".join(EXPORT_FORMATS)))
+
+
+def _normalize(key):
+    return str(key).strip().lower().lstrip("-").replace("-", "_")
+
+
+class _ErrorCapture(logging.Handler):
+    """
+    Keeps the last error logged by each thread, so that the report can show why a job failed.
+    """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = {}
+
+    def emit(self, record):
+        self.messages[record.thread] = record.getMessage()
+
+    def pop(self, thread):
+        return self.messages.pop(thread, None)
+
+
+class JobRunner:
+    """
+    Runs the jobs of a manifest in one process with a shared, authenticated MinervaClient.
+    Up to concurrency jobs run at once, and a failed job is retried up to retries times.
+    A failing job does not stop the others.
+    """
+
+    def __init__(self, client, execute, concurrency=DEFAULT_JOB_CONCURRENCY, retries=DEFAULT_JOB_RETRIES, retry_delay=2):
+        self.client = client
+        self.execute = execute
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._errors = _ErrorCapture()
+
+    def run(self, jobs):
+        logger.info("Running %s jobs, %s at a time", len(jobs), self.concurrency)
+        self._create_repositories(jobs)
+        logger.addHandler(self._errors)
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                results = list(executor.map(self._run_job, jobs))
+        finally:
+            logger.removeHandler(self._errors)
+
+        failed = sum(1 for result in results if result["status"] != "ok")
+        logger.info("%s of %s jobs completed, %s failed", len(results) - failed, len(results), failed)
+        return results
+
+    def _create_repositories(self, jobs):
+        # Import jobs running at the same time would each create a repository which does not exist yet
+        names = {}
+        for job in jobs:
+            if job.command == "import" and job.cfg.repository and not job.cfg.dryrun:
+                names[job.cfg.repository] = names.get(job.cfg.repository) or bool(job.cfg.archive)
+        if not names:
+            return
+        existing = {repository["name"] for repository in self.client.list_repositories()["included"]["repositories"]}
+        for name, archive in names.items():
+            if name not in existing:
+                result = self.client.create_repository(name, raw_storage="Archive" if archive else "Destroy")
+                logger.info("Created new repository %s, uuid: %s", name, result["data"]["uuid"])
+
+    def _run_job(self, job):
+        start = time.time()
+        error = None
+        for attempt in range(1, self.retries + 2):
+            logger.info("Job %s: %s %s (attempt %s)", job.number, job.command, job.target, attempt)
+            try:
+                status = self.execute(job.command, self.client, job.cfg)
+                error = self._errors.pop(threading.get_ident())
+                if status in (0, None):
+                    return _result(job, "ok", attempt, start)
+                error = error or "exit status {}".format(status)
+            except Exception as e:
+                self._errors.pop(threading.get_ident())
+                error = str(e)
+            except SystemExit as e:
+                # e.g. a failed login exits, which must not end the other jobs
+                error = self._errors.pop(threading.get_ident()) or "exit status {}".format(e.code)
+            logger.warning("Job %s failed: %s", job.number, error)
+            if attempt <= self.retries:
+                time.sleep(min(self.retry_delay * 2 ** (attempt - 1), 60))
+        return _result(job, "failed", self.retries + 1, start, error)
+
+
+def _result(job, status, attempts, start, error=None):
+    return {
+        "job": job.number,
+        "command": job.command,
+        "target": job.target,
+        "status": status,
+        "attempts": attempts,
+        "seconds": round(time.time() - start, 1),
+        "error": error
+    }
+
+
+def write_report(path, results):
+    """
+    Writes the job results as JSON if path ends with .json, otherwise as CSV.
+    """
+    with open(path, "w", newline="") as f:
+        if path.lower().endswith(".json"):
+            json.dump(results, f, indent=2)
+            return
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()) if results else ["job"])
+        writer.writeheader()
+        writer.writerows(results)
@@ -0,0 +1,451 @@
+import os
+import sys
+import math
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy
+import s3fs
+import zarr
+from minerva_lib.importing import MinervaImporter
+from minerva_lib.util.s3 import S3Uploader
+from tifffile import TiffFile
+from tqdm import tqdm
+
+from minerva_cli.util.dedup import TileDeduplicator, encode_tile, init_encoder, merge_summaries, report
+from minerva_cli.util.pipeline import TilePipeline
+from minerva_cli.util.profiler import stage
+from minerva_cli.util.transfer import ScheduledStore
+from minerva_cli.util.tiling import (BufferAllocator, TiffLevelReader, ZarrLevelReader, PyramidBuilder, open_ome_zarr, ome_xml,
+                                     pyramid_levels, level_dimensions)
+
+logger = logging.getLogger("minerva")
+
+# Smallest useful memory budget of one import worker, including the interpreter and libraries.
+# Tiling holds one band of rows per pyramid level and a bounded number of pending tile uploads,
+# and band buffers which do not fit in the budget are memory-mapped into temporary files.
+WORKER_MEMORY_ESTIMATE = 256 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 32
+# Same as MinervaImporter: upload threads per file and pending tile uploads without a memory budget
+UPLOAD_THREADS = 10
+MAX_PENDING_UPLOADS = 100
+MIN_TILES_PER_ENCODER = 16
+
+
+class LocalImporter(MinervaImporter):
+    """
+    MinervaImporter which streams OME-TIFFs and OME-zarr images into the tile bucket one band of rows
+    or one tile at a time, so that memory use stays within memory_limit regardless of the image size.
+    Reading, encoding (by up to encoders processes) and uploading run as the stages of a TilePipeline.
+    It takes an upload slot from a semaphore shared with the other import processes before writing each
+    tile into S3. Tile reads, encoding and writes are recorded by the profiler, if one is given,
+    and the uploads go through the TransferScheduler transfer, if one is given. Blank tiles are not
+    uploaded, and the TileDeduplicator counts blank, constant and repeated tiles.
+    """
+
+    def __init__(self, minerva_client, uploader, upload_slots=None, region="us-east-1", dryrun=False, profiler=None,
+                 memory_limit=None, transfer=None, encoders=1):
+        super().__init__(minerva_client, uploader=uploader, region=region, dryrun=dryrun)
+        self.upload_slots = upload_slots
+        self.profiler = profiler
+        self.memory_limit = memory_limit
+        self.transfer = transfer
+        self.encoders = encoders
+        self.dedup = TileDeduplicator()
+
+    def import_ome_tiff(self, file, repository, tile_size=1024, progress_callback=lambda a, b: None, image_name=None):
+        """
+        Imports an OME-TIFF into the same zarr layout as MinervaImporter. Pyramid levels are taken
+        from the file if it has them, otherwise they are built while the base level is being tiled.
+        """
+        # Half of the budget is for band buffers, a quarter for tiles waiting to be uploaded
+        allocator = BufferAllocator(self.memory_limit // 2 if self.memory_limit else None)
+        try:
+            with TiffFile(file, is_ome=False) as tif:
+                readers = [TiffLevelReader(tif, level, allocator) for level in range(len(tif.series[0].levels))]
+                metadata = tif.pages[0].tags['ImageDescription'].value
+                return self._import_levels(file, readers, metadata, repository, tile_size, allocator, progress_callback, image_name)
+        finally:
+            allocator.close()
+
+    def import_ome_zarr(self, path, repository, tile_size=1024, progress_callback=lambda a, b: None, image_name=None):
+        """
+        Imports an OME-zarr directory. Chunks which are stored like in the tile bucket are copied without decoding them.
+        """
+        allocator = BufferAllocator(self.memory_limit // 2 if self.memory_limit else None)
+        try:
+            arrays, metadata = open_ome_zarr(path)
+            # Tiles are written with the data type of the highest resolution
+            readers = [ZarrLevelReader(array, allocator, tile_size, arrays[0].dtype) for array in arrays]
+            if metadata is None:
+                base = readers[0]
+                metadata = ome_xml(os.path.basename(path), base.channels, base.height, base.width, base.dtype)
+            return self._import_levels(path, readers, metadata, repository, tile_size, allocator, progress_callback, image_name)
+        finally:
+            allocator.close()
+
+    def _import_levels(self, file, readers, metadata, repository, tile_size, allocator, progress_callback, image_name):
+        if image_name is None:
+            image_name = os.path.basename(file)
+
+        base = readers[0]
+        if len(readers) > 1:
+            dimensions = [(reader.height, reader.width) for reader in readers]
+        else:
+            dimensions = level_dimensions(base.height, base.width, pyramid_levels(base.height, base.width, tile_size))
+            logger.info("Building %s pyramid levels for %s", len(dimensions), file)
+
+        image_uuid = self.create_image(image_name,
+                                       repository,
+                                       format="zarr",
+                                       compression="zstd",
+                                       pyramid_levels=len(dimensions),
+                                       tile_size=tile_size)
+        credentials, bucket, prefix = self._get_image_credentials(image_uuid)
+
+        output = zarr.group(store=self._zarr_store(credentials, bucket, prefix), overwrite=True)
+        compressor = zarr.Blosc(cname='zstd', clevel=3)
+        arrays = [output.create(shape=(1, base.channels, 1, height, width), chunks=(1, 1, 1, tile_size, tile_size),
+                                name=str(level), dtype=base.dtype, compressor=compressor, fill_value=0)
+                  for level, (height, width) in enumerate(dimensions)]
+
+        total_tiles = sum(base.channels * math.ceil(height / tile_size) * math.ceil(width / tile_size)
+                          for height, width in dimensions)
+        self._write_tiles(readers, arrays, tile_size, allocator, lambda processed: progress_callback(processed, total_tiles))
+
+        # Metadata.xml has to be uploaded after zarr upload, otherwise zarr will overwrite the whole key
+        self.direct_import_metadata(metadata, image_uuid, credentials=credentials, bucket=bucket, prefix=prefix)
+        return image_uuid
+
+    def _write_tiles(self, readers, arrays, tile_size, allocator, progress_callback):
+        base = readers[0]
+        tile_bytes = tile_size * tile_size * base.dtype.itemsize
+        max_pending = MAX_PENDING_UPLOADS
+        if self.memory_limit:
+            max_pending = max(2, min(MAX_PENDING_UPLOADS, self.memory_limit // 4 // tile_bytes))
+        # Starting encoder processes takes a moment, so small images get fewer of them
+        encoders = max(1, min(self.encoders or 1, sum(arr.nchunks for arr in arrays) // MIN_TILES_PER_ENCODER))
+
+        tiles_processed = 0
+        channel = 0
+
+        def submitted():
+            nonlocal tiles_processed
+            progress_callback(tiles_processed)
+            tiles_processed += 1
+
+        def emit(level, y, x, tile):
+            # Band buffers are reused, so the tile is copied before it is queued
+            arr = arrays[level]
+            pipeline.submit((arr.compressor, arr.dtype, arr.fill_value, arr.chunks[-2:], numpy.array(tile)),
+                            (arr, channel, y, x, tile_size), tile.nbytes)
+            submitted()
+
+        def copy_tiles(level, reader):
+            for y in range(0, reader.height, tile_size):
+                for x in range(0, reader.width, tile_size):
+                    if reader.passthrough:
+                        with stage(self.profiler, "read chunk"):
+                            data = reader.raw_chunk(channel, y, x, tile_size)
+                        # A missing or blank chunk is left out, it reads as the fill value in both arrays
+                        if data is not None and self.dedup.is_blank_chunk(arrays[level], data):
+                            data = None
+                        pipeline.submit_encoded((data, False), (arrays[level], channel, y, x, tile_size))
+                        submitted()
+                    else:
+                        with stage(self.profiler, "read tile"):
+                            tile = reader.read_tile(channel, y, x, tile_size)
+                        emit(level, y, x, tile)
+
+        def tile_bands(reader, builder):
+            builder.reset()
+            for y in range(0, reader.height, tile_size):
+                rows = min(tile_size, reader.height - y)
+                with stage(self.profiler, "read band", rows * reader.width * reader.dtype.itemsize):
+                    band = reader.read_band(channel, y, rows)
+                builder.add_band(0, band)
+
+        if len(readers) > 1:
+            # The file has a pyramid, every level is tiled as it is. Levels whose stored chunks fit the
+            # tiles are read tile by tile, otherwise in bands of rows.
+            builders = [None if reader.passthrough or reader.tile_aligned(tile_size)
+                        else PyramidBuilder(reader.height, reader.width, reader.dtype, 1, tile_size,
+                                            lambda level, y, x, tile, offset=index: emit(offset, y, x, tile),
+                                            allocator, self.profiler)
+                        for index, reader in enumerate(readers)]
+        else:
+            builders = [PyramidBuilder(base.height, base.width, base.dtype, len(arrays), tile_size, emit,
+                                       allocator, self.profiler)]
+
+        # Tiles are read in this thread, encoded by the encoders and uploaded by the upload threads
+        with TilePipeline(encode_tile, self._upload_tile, encoders=encoders, uploaders=UPLOAD_THREADS,
+                          max_pending=max_pending, profiler=self.profiler, initializer=init_encoder) as pipeline:
+            for channel in range(base.channels):
+                for level, (reader, builder) in enumerate(zip(readers, builders)):
+                    if builder is None:
+                        copy_tiles(level, reader)
+                    else:
+                        tile_bands(reader, builder)
+            with stage(self.profiler, "wait upload"):
+                pipeline.join()
+
+    def _upload_tile(self, result, arr, channel, y, x, tile_size):
+        data, constant = result
+        self.dedup.count(data, constant)
+        if data is not None:
+            self._store_chunk(arr, channel, y, x, tile_size, data)
+
+    def _store_chunk(self, arr, channel, y, x, tile_size, data):
+        key = "{}/0.{}.0.{}.{}".format(arr.path, channel, y // tile_size, x // tile_size)
+        if self.upload_slots is None:
+            with stage(self.profiler, "write chunk", len(data)):
+                arr.store[key] = data
+            return
+
+        with stage(self.profiler, "wait upload slot"):
+            self.upload_slots.acquire()
+        try:
+            with stage(self.profiler, "write chunk", len(data)):
+                arr.store[key] = data
+        finally:
+            self.upload_slots.release()
+
+    def _zarr_store(self, credentials, bucket, prefix):
+        if self.dryrun:
+            return zarr.DirectoryStore("./zarrtmp")
+        # Botocore retries are left to the scheduler, so that it sees the throttling responses. s3fs 0.4 writes
+        # each chunk with a single put request, which it does not retry itself
+        config_kwargs = dict(retries={"max_attempts": 0}) if self.transfer is not None else {}
+        s3 = s3fs.S3FileSystem(anon=False,
+                               client_kwargs=dict(region_name=self.region),
+                               config_kwargs=config_kwargs,
+                               key=credentials["AccessKeyId"],
+                               secret=credentials["SecretAccessKey"],
+                               token=credentials["SessionToken"])
+        store = s3fs.S3Map(root=f"{bucket}/{prefix}", s3=s3, check=False, create=False)
+        return ScheduledStore(store, self.transfer) if self.transfer is not None else store
+
+
+class ImportProgress:
+    """
+    Keeps one tqdm bar per file being imported, and a combined bar for all files.
+    Progress events are tuples (index, tiles_processed, total_tiles), so that this
+    object can be used in place of a queue when importing in the main process.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.bars = {}
+        self.processed = {}
+        self.total = tqdm(unit="tiles", desc="Total", position=0)
+
+    def put(self, event):
+        index, processed, total = event
+        bar = self.bars.get(index)
+        if bar is None:
+            bar = tqdm(unit="tiles", desc=os.path.basename(self.files[index]), position=len(self.bars) + 1, leave=False)
+            self.bars[index] = bar
+            self.processed[index] = 0
+
+        bar.total = total
+        bar.update(processed - self.processed[index])
+        self.total.update(processed - self.processed[index])
+        self.processed[index] = processed
+
+    def drain(self, queue):
+        while not queue.empty():
+            self.put(queue.get())
+
+    def tiles(self, index):
+        return self.processed.get(index, 0)
+
+    def finish(self, index):
+        bar = self.bars.pop(index, None)
+        if bar is not None:
+            bar.close()
+
+    def close(self):
+        for index in list(self.bars):
+            self.finish(index)
+        self.total.close()
+
+
+def _init_worker(logging_level, stream_name):
+    # Streams cannot be sent to spawned workers, so they log to the standard stream of the main process by name
+    logging.basicConfig(stream=getattr(sys, stream_name), level=logging_level,
+                        format='%(asctime)-15s %(levelname)-8s - %(message)s')
+
+
+def _log_stream_name():
+    for handler in logging.getLogger().handlers:
+        if getattr(handler, "stream", None) is sys.stderr:
+            return "stderr"
+    return "stdout"
+
+
+def import_file(client, cfg, index, file, progress_queue, upload_slots=None, memory_limit=None, transfer=None, encoders=1):
+    """
+    Imports a single OME-TIFF or OME-zarr directory. Runs either in the main process or in a pool worker.
+    Returns the import time in seconds and the TileDeduplicator summary of the file.
+    """
+    importer = LocalImporter(client,
+                             uploader=S3Uploader(region=cfg.region),
+                             upload_slots=upload_slots,
+                             region=cfg.region,
+                             dryrun=cfg.dryrun,
+                             profiler=cfg.profiler,
+                             memory_limit=memory_limit,
+                             transfer=transfer,
+                             encoders=encoders)
+
+    def show_progress(processed, total):
+        progress_queue.put((index, processed + 1, total))
+
+    import_image = importer.import_ome_zarr if os.path.isdir(file) else importer.import_ome_tiff
+    start = time.time()
+    with stage(cfg.profiler, "import file", _get_size(file), file=file):
+        import_image(file,
+                     repository=cfg.repository,
+                     progress_callback=show_progress,
+                     image_name=cfg.image_name)
+    return time.time() - start, importer.dedup.summary()
+
+
+def _import_file_in_worker(client, cfg, index, file, progress_queue, upload_slots, memory_limit, transfer, encoders):
+    """
+    Runs import_file in a pool worker, and returns the tile summary, profile events and transfer counters of the worker.
+    """
+    seconds, tiles = import_file(client, cfg, index, file, progress_queue, upload_slots, memory_limit, transfer, encoders)
+    events = cfg.profiler.events if cfg.profiler is not None else []
+    return seconds, tiles, events, transfer.summary() if transfer is not None else None
+
+
+def run_local_import(client, cfg, files):
+    """
+    Imports the given OME-TIFFs and OME-zarr directories, running up to cfg.workers files at once in a process pool.
+    Returns a list of per-file results, a failing file does not stop the others.
+    """
+    results = {}
+    jobs = []
+    for index, file in enumerate(files):
+        if not os.path.exists(file):
+            logger.warning("File does not exist: %s", file)
+            results[index] = _result(file, "missing")
+        elif not _is_local_importable(file):
+            logger.warning("Only OME-TIFFs and OME-zarr directories can be imported with local import.")
+            logger.warning("Skipping file %s", file)
+            results[index] = _result(file, "skipped")
+        else:
+            jobs.append((index, file))
+
+    workers = _get_worker_count(cfg, len(jobs))
+    progress = ImportProgress(files)
+    tile_summaries = []
+    start = time.time()
+    try:
+        if workers <= 1:
+            for index, file in jobs:
+                logger.info("Importing file %s", file)
+                try:
+                    seconds, tiles = import_file(client, cfg, index, file, progress, memory_limit=cfg.max_memory,
+                                                 transfer=cfg.transfer, encoders=_get_encoder_count(cfg, workers))
+                    results[index] = _result(file, "imported", progress.tiles(index), seconds, tiles)
+                    tile_summaries.append(tiles)
+                except Exception as e:
+                    logger.error("Importing %s failed: %s", file, e)
+                    results[index] = _result(file, "failed", progress.tiles(index), error=e)
+                progress.finish(index)
+        else:
+            _run_pool(client, cfg, jobs, workers, progress, results, tile_summaries)
+    finally:
+        progress.close()
+
+    elapsed = time.time() - start
+    total_tiles = sum(result["tiles"] for result in results.values())
+    logger.info("Imported %s tiles in %.1f s (%.1f tiles/s)", total_tiles, elapsed, total_tiles / max(elapsed, 1e-6))
+    if tile_summaries:
+        logger.info(report(merge_summaries(tile_summaries)))
+    return [results[index] for index in sorted(results)]
+
+
+def _run_pool(client, cfg, jobs, workers, progress, results, tile_summaries):
+    upload_concurrency = cfg.upload_concurrency or DEFAULT_UPLOAD_CONCURRENCY
+    memory_limit = cfg.max_memory // workers if cfg.max_memory is not None else None
+    # Each worker gets its own scheduler with a share of the bandwidth, and their counters are added up here
+    transfer = cfg.transfer.share(workers) if cfg.transfer is not None else None
+    encoders = _get_encoder_count(cfg, workers)
+    logger.info("Importing %s files with %s workers (upload concurrency %s)", len(jobs), workers, upload_concurrency)
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        queue = manager.Queue()
+        upload_slots = manager.BoundedSemaphore(upload_concurrency)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(logger.getEffectiveLevel(), _log_stream_name())) as executor:
+            futures = {}
+            for index, file in jobs:
+                future = executor.submit(_import_file_in_worker, client, cfg, index, file, queue, upload_slots, memory_limit,
+                                         transfer, encoders)
+                futures[future] = (index, file)
+
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                progress.drain(queue)
+                for future in done:
+                    index, file = futures[future]
+                    try:
+                        seconds, tiles, events, transfer_summary = future.result()
+                        if cfg.profiler is not None:
+                            cfg.profiler.merge(events)
+                        if transfer_summary is not None:
+                            cfg.transfer.merge(transfer_summary)
+                        results[index] = _result(file, "imported", progress.tiles(index), seconds, tiles)
+                        tile_summaries.append(tiles)
+                    except Exception as e:
+                        logger.error("Importing %s failed: %s", file, e)
+                        results[index] = _result(file, "failed", progress.tiles(index), error=e)
+                    progress.finish(index)
+
+
+def _get_worker_count(cfg, num_jobs):
+    workers = min(cfg.workers or 1, num_jobs)
+    if cfg.max_memory is not None:
+        memory_workers = max(1, cfg.max_memory // WORKER_MEMORY_ESTIMATE)
+        if memory_workers < workers:
+            logger.warning("Limiting workers to %s because of memory budget %s bytes", memory_workers, cfg.max_memory)
+            workers = memory_workers
+    return workers
+
+
+def _get_encoder_count(cfg, workers):
+    # By default the CPUs are divided between the workers
+    return cfg.encoders or max(1, (os.cpu_count() or 1) // workers)
+
+
+def _is_local_importable(file):
+    name = os.path.basename(os.path.normpath(file))
+    if os.path.isdir(file):
+        return name.endswith(".zarr")
+    return name.endswith(".ome.tif")
+
+
+def _get_size(file):
+    if not os.path.isdir(file):
+        return os.path.getsize(file)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(file) for name in names)
+
+
+def _result(file, status, tiles=0, seconds=None, dedup=None, error=None):
+    rate = tiles / seconds if seconds else None
+    return {
+        "file": file,
+        "status": status,
+        "tiles": tiles,
+        "blank": dedup["blank"] if dedup is not None else None,
+        "duplicates": dedup["duplicates"] if dedup is not None else None,
+        "seconds": round(seconds, 1) if seconds is not None else None,
+        "tiles/s": round(rate, 1) if rate is not None else None,
+        "error": str(error) if error is not None else None
+    }
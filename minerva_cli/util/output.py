@@ -0,0 +1,88 @@
+import csv
+import json
+import sys
+
+import tabulate
+
+EXPORT_FORMATS = ["zarr", "tif", "tiff"]
+EXPORT_COMPRESSIONS = ["none", "zstd", "lz4", "deflate"]
+OUTPUT_FORMATS = ["table", "json", "csv"]
+
+
+def print_table(rows, output_format=None, stream=None):
+    """
+    Prints a list of dicts as a table, or as JSON or CSV for other tools to parse.
+    """
+    if not is_machine_readable(output_format):
+        print(tabulate.tabulate(rows, headers="keys"), file=stream or sys.stdout)
+        return
+
+    printer = RowPrinter(output_format, stream)
+    printer.write(rows)
+    printer.close()
+
+
+def is_machine_readable(output_format):
+    return output_format in ("json", "csv")
+
+
+class RowPrinter:
+    """
+    Prints rows as they arrive, e.g. one page of a listing at a time. The columns
+    are taken from the first rows; table columns are aligned to the widths of the first rows.
+    """
+
+    def __init__(self, output_format=None, stream=None):
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.keys = None
+        self.widths = None
+        self.writer = None
+        self.count = 0
+
+    def write(self, rows):
+        if len(rows) == 0:
+            return
+        if self.keys is None:
+            self.keys = []
+            for row in rows:
+                self.keys.extend(key for key in row if key not in self.keys)
+
+        if self.output_format == "json":
+            for row in rows:
+                self.stream.write("[\n" if self.count == 0 else ",\n")
+                self.stream.write(json.dumps(row, default=str))
+                self.count += 1
+        elif self.output_format == "csv":
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.stream, fieldnames=self.keys, extrasaction="ignore")
+                self.writer.writeheader()
+            self.writer.writerows(rows)
+            self.count += len(rows)
+        else:
+            self._write_table(rows)
+        self.stream.flush()
+
+    def close(self):
+        if self.output_format == "json":
+            self.stream.write("[]\n" if self.count == 0 else "\n]\n")
+        elif self.output_format != "csv" and self.count == 0:
+            self.stream.write("\n")
+        self.stream.flush()
+
+    def _write_table(self, rows):
+        values = [[_cell(row.get(key)) for key in self.keys] for row in rows]
+        if self.widths is None:
+            table = tabulate.tabulate(values, headers=self.keys, disable_numparse=True)
+            lines = table.splitlines()
+            # The separator line below the headers gives the column widths
+            self.widths = [len(dashes) for dashes in lines[1].split("  ")]
+            self.stream.write(table + "\n")
+        else:
+            for row in values:
+                self.stream.write("  ".join(value.ljust(width) for value, width in zip(row, self.widths)).rstrip() + "\n")
+        self.count += len(rows)
+
+
+def _cell(value):
+    return "" if value is None else str(value)
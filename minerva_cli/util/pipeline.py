@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from minerva_cli.util.profiler import stage
+
+logger = logging.getLogger("minerva")
+
+# Queue depths are logged at most this often with --debug
+DEPTH_LOG_INTERVAL = 2
+
+
+class TilePipeline:
+    """
+    Runs tiles through three stages, so that reading, encoding and uploading overlap: the caller reads
+    tiles and submits them, encoders compress them, and upload threads store the encoded chunks.
+    encode(*encode_args) must be a module-level function when encoders > 1, because it then runs in a pool
+    of encoder processes, which are set up by initializer; upload(result, *upload_args) runs in upload threads.
+
+    The queues between the stages are bounded: submit() blocks while max_pending tiles are in the pipeline,
+    or while max_encoding tiles are waiting for an encoder, so that memory use stays bounded and reading
+    slows down to the pace of the slowest stage. The first error of an encoder or upload is raised
+    by the next submit() or by join().
+    """
+
+    def __init__(self, encode, upload, encoders=1, uploaders=10, max_pending=100, max_encoding=None, profiler=None,
+                 initializer=None):
+        self.encode = encode
+        self.upload = upload
+        self.profiler = profiler
+        self.encoders = encoders
+        self.encoding = 0
+        self.uploading = 0
+        self.error = None
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._encoding_slots = threading.BoundedSemaphore(max_encoding or max(2, 2 * encoders))
+        self._condition = threading.Condition()
+        self._futures = set()
+        self._cancelled = False
+        self._last_log = time.monotonic()
+
+        # Worker processes of Python < 3.9 are daemons, which cannot start processes of their own
+        if encoders > 1 and not multiprocessing.current_process().daemon:
+            self._encoder = ProcessPoolExecutor(max_workers=encoders, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=initializer)
+        else:
+            self._encoder = ThreadPoolExecutor(max_workers=max(1, encoders))
+        self._uploader = ThreadPoolExecutor(max_workers=uploaders)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+        self._encoder.shutdown(wait=True)
+        self._uploader.shutdown(wait=True)
+
+    def submit(self, encode_args, upload_args, num_bytes=0):
+        """
+        Queues a tile for encoding and then uploading. Blocks while the queues are full.
+        """
+        self._acquire(self._pending, "wait pipeline")
+        try:
+            self._acquire(self._encoding_slots, "wait encoder")
+        except BaseException:
+            self._pending.release()
+            raise
+        with self._condition:
+            self.encoding += 1
+        future = self._encoder.submit(_timed, self.encode, encode_args)
+        with self._condition:
+            self._futures.add(future)
+        future.add_done_callback(lambda done: self._encoded(done, upload_args, num_bytes))
+        self._log_depth()
+
+    def submit_encoded(self, result, upload_args):
+        """
+        Queues an already encoded tile for uploading. Blocks while the queues are full.
+        """
+        self._acquire(self._pending, "wait pipeline")
+        with self._condition:
+            self.uploading += 1
+        self._uploader.submit(self._upload, result, upload_args)
+        self._log_depth()
+
+    def join(self):
+        """
+        Waits until all submitted tiles have been uploaded, and raises the first error.
+        """
+        with self._condition:
+            while self.encoding + self.uploading > 0:
+                self._condition.wait()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        """
+        Drops the tiles which have not been encoded or uploaded yet.
+        """
+        with self._condition:
+            self._cancelled = True
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def _acquire(self, semaphore, name):
+        if self.error is not None:
+            raise self.error
+        if not semaphore.acquire(blocking=False):
+            with stage(self.profiler, name):
+                semaphore.acquire()
+
+    def _encoded(self, future, upload_args, num_bytes):
+        # Runs in the thread which completed the encoding, so it only hands the tile to the upload threads
+        self._encoding_slots.release()
+        with self._condition:
+            self._futures.discard(future)
+            self.encoding -= 1
+            self.uploading += 1
+        try:
+            result, start, seconds = future.result()
+            if self.profiler is not None:
+                self.profiler.record("encode tile", start, seconds, num_bytes)
+            self._uploader.submit(self._upload, result, upload_args)
+        except BaseException as e:
+            self._finished(e)
+
+    def _upload(self, result, upload_args):
+        error = None
+        try:
+            if not self._cancelled:
+                self.upload(result, *upload_args)
+        except BaseException as e:
+            error = e
+        self._finished(error)
+
+    def _finished(self, error=None):
+        self._pending.release()
+        with self._condition:
+            self.uploading -= 1
+            if error is not None and self.error is None and not self._cancelled:
+                self.error = error
+            self._condition.notify_all()
+
+    def _log_depth(self):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        now = time.monotonic()
+        if now - self._last_log < DEPTH_LOG_INTERVAL:
+            return
+        self._last_log = now
+        logger.debug("Tile pipeline: %s tiles encoding (%s encoders), %s uploading", self.encoding, self.encoders,
+                     self.uploading)
+
+
+def _timed(function, args):
+    start = time.time()
+    result = function(*args)
+    return result, start, time.time() - start
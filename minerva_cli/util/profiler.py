@@ -0,0 +1,161 @@
+import os
+import re
+import math
+import json
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger("minerva")
+
+# Upper bounds of the duration histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+UUID_PATTERN = "[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+
+
+class Profiler:
+    """
+    Records the duration and byte count of each hot path stage, e.g. reading a tile, uploading it,
+    or an API request. The profile is saved as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+    with a summary of each stage: count, bytes, histogram and p50/p99/max durations.
+
+    A Profiler can be sent to worker processes; the copy starts empty, and the events recorded
+    in the worker are sent back and added to the original with merge().
+    """
+
+    def __init__(self, path, cprofile=False):
+        self.path = path
+        self.cprofile = cprofile
+        self.events = []
+        self._lock = threading.Lock()
+        self._cprofiler = None
+
+    def __getstate__(self):
+        return {"path": self.path, "cprofile": False}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["cprofile"])
+
+    def start(self):
+        if self.cprofile:
+            import cProfile
+
+            self._cprofiler = cProfile.Profile()
+            self._cprofiler.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name, num_bytes=0, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time() - start, num_bytes, **args)
+
+    def record(self, name, start, seconds, num_bytes=0, **args):
+        event = {"stage": name, "start": start, "seconds": seconds, "bytes": num_bytes,
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def merge(self, events):
+        with self._lock:
+            self.events.extend(events)
+
+    def instrument_client(self, client):
+        """
+        Records every API request of the MinervaClient, grouped by method and path without uuids.
+        """
+        import requests
+
+        if client.session is None:
+            client.session = requests.Session()
+        client.session.hooks["response"].append(self._record_response)
+
+    def _record_response(self, response, *args, **kwargs):
+        seconds = response.elapsed.total_seconds()
+        path = re.sub(UUID_PATTERN, "{uuid}", response.request.path_url.split("?")[0])
+        self.record("api " + response.request.method + " " + path, time.time() - seconds, seconds,
+                    len(response.content), status=response.status_code)
+
+    def summary(self):
+        stages = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            stages.setdefault(event["stage"], []).append(event)
+
+        summary = {}
+        for name, stage_events in sorted(stages.items()):
+            durations = sorted(event["seconds"] for event in stage_events)
+            total = sum(durations)
+            num_bytes = sum(event["bytes"] for event in stage_events)
+            histogram = {}
+            for duration in durations:
+                bucket = next((bound for bound in HISTOGRAM_BUCKETS_MS if duration * 1000 <= bound), None)
+                label = "<={}ms".format(bucket) if bucket is not None else ">{}ms".format(HISTOGRAM_BUCKETS_MS[-1])
+                histogram[label] = histogram.get(label, 0) + 1
+            summary[name] = {
+                "count": len(durations),
+                "total_s": round(total, 3),
+                "p50_ms": round(_percentile(durations, 50) * 1000, 2),
+                "p99_ms": round(_percentile(durations, 99) * 1000, 2),
+                "max_ms": round(durations[-1] * 1000, 2),
+                "bytes": num_bytes,
+                "MB/s": round(num_bytes / 1e6 / total, 2) if total > 0 and num_bytes else None,
+                "histogram": histogram
+            }
+        return summary
+
+    def save(self):
+        """
+        Writes the trace and summary into path, and the cProfile statistics into path + ".pstats".
+        """
+        if self._cprofiler is not None:
+            self._cprofiler.disable()
+            self._cprofiler.dump_stats(self.path + ".pstats")
+            logger.info("Python profile saved as %s.pstats", self.path)
+
+        with self._lock:
+            events = list(self.events)
+        origin = min((event["start"] for event in events), default=0)
+        trace_events = []
+        for event in events:
+            args = dict(event.get("args", {}), bytes=event["bytes"])
+            trace_events.append({"name": event["stage"], "cat": event["stage"].split(" ")[0], "ph": "X",
+                                 "ts": round((event["start"] - origin) * 1e6), "dur": round(event["seconds"] * 1e6),
+                                 "pid": event["pid"], "tid": event["tid"], "args": args})
+
+        summary = self.summary()
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms", "stages": summary}, f)
+
+        for name, stage in summary.items():
+            logger.info("%-40s %6s x  p50 %8.2f ms  p99 %8.2f ms  total %7.2f s%s", name, stage["count"],
+                        stage["p50_ms"], stage["p99_ms"], stage["total_s"],
+                        "  {:.2f} MB/s".format(stage["MB/s"]) if stage["MB/s"] else "")
+        logger.info("Profile saved as %s", self.path)
+
+
+def _percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(0, rank - 1)]
+
+
+@contextlib.contextmanager
+def stage(profiler, name, num_bytes=0, **args):
+    """
+    Records a stage if profiling is enabled, i.e. profiler is not None.
+    """
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name, num_bytes, **args):
+            yield
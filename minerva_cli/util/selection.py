@@ -0,0 +1,148 @@
+import math
+import logging
+
+logger = logging.getLogger("minerva")
+
+
+class ExportSelection:
+    """
+    Part of an image to export: channels, timepoint, z-plane, the first pyramid level and a region
+    of interest (x, y, width, height) in full resolution pixels. The region is scaled down for
+    lower pyramid levels, so that every exported level covers the same area.
+    """
+
+    def __init__(self, channels=None, level=0, roi=None, timepoint=0, z=0):
+        self.channels = channels
+        self.level = level or 0
+        self.roi = roi
+        self.timepoint = timepoint or 0
+        self.z = z or 0
+
+    def is_subset(self):
+        return (self.channels is not None or self.level > 0 or self.roi is not None
+                or self.timepoint > 0 or self.z > 0)
+
+    def validate(self, num_channels, height, width, num_levels, size_t=1, size_z=1):
+        """
+        Raises ValueError if the selection is outside of the image.
+        """
+        for channel in self.channels or []:
+            if channel >= num_channels:
+                raise ValueError("Channel {} does not exist, the image has {} channels".format(channel, num_channels))
+        if self.level >= num_levels:
+            raise ValueError("Level {} does not exist, the image has {} pyramid levels".format(self.level, num_levels))
+        if self.timepoint >= size_t:
+            raise ValueError("Timepoint {} does not exist, the image has {} timepoints".format(self.timepoint, size_t))
+        if self.z >= size_z:
+            raise ValueError("Z-plane {} does not exist, the image has {} z-planes".format(self.z, size_z))
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            if x >= width or y >= height:
+                raise ValueError("Region {} is outside of the image ({}x{})".format(",".join(map(str, self.roi)), width, height))
+
+    def selected_channels(self, num_channels):
+        return self.channels if self.channels is not None else list(range(num_channels))
+
+    def level_region(self, level, height, width):
+        """
+        Returns the selected rows and columns (y0, y1, x0, x1) of a pyramid level with the given dimensions.
+        """
+        if self.roi is None:
+            return 0, height, 0, width
+        x, y, w, h = self.roi
+        scale = 2 ** level
+        return (min(y // scale, height), min(math.ceil((y + h) / scale), height),
+                min(x // scale, width), min(math.ceil((x + w) / scale), width))
+
+    def includes_tile(self, level, channel, timepoint, z, y, x, tile_size):
+        """
+        Whether the tile at the given tile indices (not pixels) is needed for the selection.
+        """
+        if level < self.level or timepoint != self.timepoint or z != self.z:
+            return False
+        if self.channels is not None and channel not in self.channels:
+            return False
+        if self.roi is None:
+            return True
+        # Dimensions of the level are not needed, the region is only compared with tile bounds
+        y0, y1, x0, x1 = self.level_region(level, math.inf, math.inf)
+        return (y * tile_size < y1 and (y + 1) * tile_size > y0
+                and x * tile_size < x1 and (x + 1) * tile_size > x0)
+
+
+def parse_indices(value):
+    """
+    Parses a list of indices and ranges, e.g. "0,2,4-6", into a sorted list of integers.
+    """
+    if value is None:
+        return None
+    indices = set()
+    try:
+        for part in str(value).split(","):
+            part = part.strip()
+            if "-" in part:
+                start, end = part.split("-")
+                indices.update(range(int(start), int(end) + 1))
+            elif part:
+                indices.add(int(part))
+    except ValueError:
+        raise ValueError("Invalid index list: {}".format(value))
+    return sorted(indices)
+
+
+def parse_roi(value):
+    """
+    Parses a region of interest "x,y,width,height" in pixels.
+    """
+    if value is None:
+        return None
+    try:
+        roi = tuple(int(part) for part in str(value).split(","))
+    except ValueError:
+        roi = ()
+    if len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= 0 or roi[3] <= 0:
+        raise ValueError("Invalid region, expected x,y,width,height: {}".format(value))
+    return roi
+
+
+def subset_ome_metadata(ome_metadata, channels, height, width, level):
+    """
+    Adjusts the OME-XML of an image to an exported subset: dimensions, channels and, for lower
+    pyramid levels, physical pixel sizes. Planes and TiffData of the original file are removed,
+    because they refer to the pages of the original image.
+    """
+    import xml.etree.ElementTree as ElementTree
+
+    if isinstance(ome_metadata, bytes):
+        ome_metadata = ome_metadata.decode("utf-8")
+    try:
+        root = ElementTree.fromstring(ome_metadata)
+    except ElementTree.ParseError as e:
+        logger.warning("Could not parse OME-XML, exporting the original metadata: %s", e)
+        return ome_metadata
+
+    namespace = root.tag[1:].split("}")[0] if root.tag.startswith("{") else ""
+    ElementTree.register_namespace("", namespace)
+    prefix = "{" + namespace + "}" if namespace else ""
+    pixels = root.find("{0}Image/{0}Pixels".format(prefix))
+    if pixels is None:
+        return ome_metadata
+
+    pixels.set("SizeX", str(width))
+    pixels.set("SizeY", str(height))
+    pixels.set("SizeC", str(len(channels)))
+    pixels.set("SizeT", "1")
+    pixels.set("SizeZ", "1")
+    for name in ("PhysicalSizeX", "PhysicalSizeY"):
+        if level > 0 and pixels.get(name) is not None:
+            pixels.set(name, str(float(pixels.get(name)) * 2 ** level))
+
+    for index, channel in enumerate(pixels.findall(prefix + "Channel")):
+        if index not in channels:
+            pixels.remove(channel)
+    for index, channel in enumerate(pixels.findall(prefix + "Channel")):
+        channel.set("ID", "Channel:0:{}".format(index))
+    for element in pixels.findall(prefix + "Plane") + pixels.findall(prefix + "TiffData"):
+        pixels.remove(element)
+
+    return ElementTree.tostring(root, encoding="unicode")
@@ -0,0 +1,319 @@
+import os
+import json
+import math
+import mmap
+import logging
+import tempfile
+
+import numpy
+import zarr
+
+from minerva_cli.util.profiler import stage
+
+logger = logging.getLogger("minerva")
+
+
+class BufferAllocator:
+    """
+    Allocates the band buffers of a tiler. Buffers are kept in memory until memory_limit bytes
+    have been allocated, after that they are backed by temporary files (numpy.memmap), so that
+    the operating system can write them out instead of the process running out of memory.
+    """
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit
+        self.allocated = 0
+        self._files = []
+
+    def empty(self, shape, dtype):
+        nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        if self.memory_limit is None or self.allocated + nbytes <= self.memory_limit:
+            self.allocated += nbytes
+            return numpy.empty(shape, dtype=dtype)
+
+        logger.debug("Memory-mapping a %s MB band buffer", nbytes // 1024 // 1024)
+        f = tempfile.TemporaryFile(prefix="minerva-band-")
+        self._files.append(f)
+        return numpy.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+
+class ArrayReader:
+    """
+    Reads one pyramid level from a zarr array of shape (C, Y, X), (Y, X) or (1, C, 1, Y, X),
+    either in bands of rows or tile by tile.
+    """
+
+    def __init__(self, array, allocator):
+        self.array = array
+        self.channels, self.height, self.width = _get_dimensions(array)
+        self.dtype = array.dtype
+        self.allocator = allocator
+        # Whether stored chunks can be copied into the tile bucket as they are, see ZarrLevelReader.raw_chunk()
+        self.passthrough = False
+        self._band = None
+
+    def read_band(self, channel, y, rows):
+        """
+        Returns rows of the channel starting from row y. The returned array may be reused by the next call.
+        """
+        if self._band is None:
+            self._band = self.allocator.empty((rows, self.width), self.dtype)
+        out = self._band[:rows]
+        self.array.get_basic_selection(self._selection(channel, slice(y, y + rows), slice(None)), out=out)
+        return out
+
+    def read_tile(self, channel, y, x, tile_size):
+        return self.array.get_basic_selection(self._selection(channel, slice(y, y + tile_size), slice(x, x + tile_size)))
+
+    def tile_aligned(self, tile_size):
+        """
+        Whether the stored chunks (TIFF tiles or strips, zarr chunks) fit evenly into tiles,
+        so that reading tile by tile decodes each stored chunk only once.
+        """
+        chunk_height, chunk_width = self.array.chunks[-2:]
+        return tile_size % chunk_height == 0 and tile_size % chunk_width == 0
+
+    def _selection(self, channel, rows, columns):
+        if len(self.array.shape) == 5:
+            return (0, channel, 0, rows, columns)
+        if len(self.array.shape) == 3:
+            return (channel, rows, columns)
+        return (rows, columns)
+
+
+class TiffLevelReader(ArrayReader):
+    """
+    Reads one pyramid level of an OME-TIFF. Uncompressed pages are memory-mapped directly from the file,
+    and the pages of each band are released when the next band is read, so that the mapped file does not
+    accumulate in memory. Other pages are decoded through tifffile's zarr store, which decodes only the
+    strips or tiles overlapping the band or tile being read.
+    """
+
+    def __init__(self, tif, level, allocator):
+        super().__init__(zarr.open(tif.aszarr(series=0, level=level), mode="r"), allocator)
+        self._mmap = None
+        self._offsets = None
+        self._previous = None
+        self.planes = self._memmap_planes(tif, tif.series[0].levels[level].pages)
+
+    def read_band(self, channel, y, rows):
+        if self.planes is None:
+            return super().read_band(channel, y, rows)
+
+        self._release_previous()
+        self._previous = (channel, y, rows)
+        return self.planes[channel][y:y + rows]
+
+    def tile_aligned(self, tile_size):
+        # Memory-mapped planes are read in bands, which can be released row by row
+        return self.planes is None and super().tile_aligned(tile_size)
+
+    def _memmap_planes(self, tif, pages):
+        if len(pages) != self.channels:
+            return None
+        for page in pages:
+            if page is None or not page.is_memmappable or page.keyframe.shape != (self.height, self.width):
+                return None
+
+        with open(tif.filehandle.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = [page.dataoffsets[0] for page in pages]
+        dtype = numpy.dtype(tif.byteorder + pages[0].keyframe.dtype.char)
+        logger.debug("Memory-mapping %s uncompressed planes", len(pages))
+        return [numpy.ndarray((self.height, self.width), dtype=dtype, buffer=self._mmap, offset=offset)
+                for offset in self._offsets]
+
+    def _release_previous(self):
+        # Dropping the pages of a read-only mapping only discards them from memory,
+        # they would be read from the file again if needed
+        if self._previous is None or not hasattr(self._mmap, "madvise"):
+            return
+        channel, y, rows = self._previous
+        row_bytes = self.width * self.dtype.itemsize
+        start = self._offsets[channel] + y * row_bytes
+        aligned = start - start % mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_DONTNEED, aligned, start + rows * row_bytes - aligned)
+
+
+
+class ZarrLevelReader(ArrayReader):
+    """
+    Reads one pyramid level of an OME-zarr image. Chunks which are already stored in the same
+    layout and compression as the tile bucket are passed through without decoding them.
+    """
+
+    def __init__(self, array, allocator, tile_size, output_dtype, output_fill_value=0):
+        super().__init__(array, allocator)
+        self.passthrough = _is_compatible(array, tile_size, output_dtype, output_fill_value)
+        metadata = json.loads(bytes(array.store[_join(array.path, ".zarray")]))
+        self.separator = metadata.get("dimension_separator") or "."
+
+    def raw_chunk(self, channel, y, x, tile_size):
+        """
+        Returns the stored, encoded chunk of the tile, or None if the chunk does not exist.
+        Used only when passthrough is set.
+        """
+        key = self.separator.join(str(i) for i in (0, channel, 0, y // tile_size, x // tile_size))
+        return self.array.store.get(_join(self.array.path, key))
+
+
+def open_ome_zarr(path):
+    """
+    Opens an OME-zarr directory (OME-NGFF multiscales, optionally in bioformats2raw layout).
+    Returns the arrays of the pyramid levels, highest resolution first, and the OME-XML metadata if the directory has it.
+    """
+    root = zarr.open_group(path, mode="r")
+    group = root
+    if "multiscales" not in root.attrs and "0" in root and "multiscales" in root["0"].attrs:
+        # bioformats2raw layout: the first series is in group "0", OME-XML in OME/METADATA.ome.xml
+        group = root["0"]
+    if "multiscales" not in group.attrs:
+        raise ValueError("{} is not an OME-zarr image: multiscales metadata is missing".format(path))
+
+    datasets = group.attrs["multiscales"][0]["datasets"]
+    arrays = [group[dataset["path"]] for dataset in datasets]
+    for array in arrays:
+        if len(array.shape) == 5 and (array.shape[0] != 1 or array.shape[2] != 1):
+            raise ValueError("Only images with one timepoint and one z-plane can be imported: {}".format(path))
+        if len(array.shape) not in (2, 3, 5):
+            raise ValueError("Unsupported OME-zarr dimensions {} in {}".format(array.shape, path))
+
+    metadata = None
+    metadata_path = os.path.join(path, "OME", "METADATA.ome.xml")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path, encoding="utf-8") as f:
+            metadata = f.read()
+    return arrays, metadata
+
+
+def ome_xml(name, channels, height, width, dtype):
+    """
+    Minimal OME-XML for an image which has no metadata of its own.
+    """
+    import tifffile
+
+    ome = tifffile.OmeXml()
+    ome.addimage(dtype, (channels, height, width), (channels, 1, 1, height, width, 1), axes="CYX", Name=name)
+    return ome.tostring()
+
+
+class PyramidBuilder:
+    """
+    Builds the pyramid levels below the base level incrementally. Each band of tile_size rows
+    of a level is cut into tiles, and downsampled 2x2 into the band buffer of the next level,
+    which is emitted when it is full. Only one band per level is held, so memory use
+    depends on the image width but not on its height.
+    """
+
+    def __init__(self, height, width, dtype, num_levels, tile_size, emit, allocator, profiler=None):
+        self.tile_size = tile_size
+        self.emit = emit
+        self.profiler = profiler
+        self.levels = []
+        for level in range(num_levels):
+            self.levels.append({"height": height, "width": width, "y": 0, "rows": 0,
+                                "buffer": allocator.empty((tile_size, width), dtype) if level > 0 else None})
+            height = math.ceil(height / 2)
+            width = math.ceil(width / 2)
+
+    def reset(self):
+        """
+        Starts a new channel, reusing the band buffers.
+        """
+        for state in self.levels:
+            state["y"] = 0
+            state["rows"] = 0
+
+    def add_band(self, level, band):
+        """
+        Adds the next band of rows of the level. Bands of the base level must be tile_size rows,
+        except for the last one.
+        """
+        state = self.levels[level]
+        y = state["y"]
+        for x in range(0, state["width"], self.tile_size):
+            self.emit(level, y, x, band[:, x:x + self.tile_size])
+        state["y"] += band.shape[0]
+
+        if level + 1 < len(self.levels):
+            with stage(self.profiler, "downsample", band.nbytes):
+                half = downsample(band)
+            self._append(level + 1, half, last=state["y"] >= state["height"])
+
+    def _append(self, level, rows, last):
+        state = self.levels[level]
+        state["buffer"][state["rows"]:state["rows"] + rows.shape[0]] = rows
+        state["rows"] += rows.shape[0]
+        if state["rows"] == self.tile_size or last:
+            filled = state["rows"]
+            state["rows"] = 0
+            self.add_band(level, state["buffer"][:filled])
+
+
+def downsample(band, columns=4096):
+    """
+    Halves the height and width of a 2-D array by averaging 2x2 blocks. Odd edges are padded by
+    repeating the last row or column. The band is processed in blocks of columns, so that the
+    temporary floating point arrays stay small.
+    """
+    height, width = band.shape
+    out = numpy.empty((math.ceil(height / 2), math.ceil(width / 2)), dtype=band.dtype)
+    for x in range(0, width, columns):
+        block = band[:, x:x + columns]
+        if block.shape[0] % 2 or block.shape[1] % 2:
+            block = numpy.pad(block, ((0, block.shape[0] % 2), (0, block.shape[1] % 2)), mode="edge")
+        blocks = block.reshape(block.shape[0] // 2, 2, block.shape[1] // 2, 2)
+        mean = blocks.mean(axis=(1, 3), dtype=numpy.float64 if band.dtype.itemsize > 2 else numpy.float32)
+        if band.dtype.kind in "iu":
+            mean = numpy.rint(mean)
+        out[:, x // 2:x // 2 + mean.shape[1]] = mean
+    return out
+
+
+def pyramid_levels(height, width, tile_size):
+    """
+    Number of pyramid levels needed until the image fits into one tile.
+    """
+    return 1 + max(0, math.ceil(math.log2(max(height, width) / tile_size)))
+
+
+def level_dimensions(height, width, num_levels):
+    dimensions = []
+    for level in range(num_levels):
+        dimensions.append((height, width))
+        height = math.ceil(height / 2)
+        width = math.ceil(width / 2)
+    return dimensions
+
+
+def _get_dimensions(array):
+    # Same interpretation as MinervaImporter: (channels, height, width) or (height, width),
+    # and the (t, c, z, y, x) layout of the tile bucket
+    if len(array.shape) == 5:
+        return array.shape[1], array.shape[3], array.shape[4]
+    if len(array.shape) == 3:
+        return array.shape
+    return 1, array.shape[0], array.shape[1]
+
+
+def _is_compatible(array, tile_size, dtype, fill_value):
+    compressor = array.compressor
+    # numpy dtypes of different byte order are not equal, e.g. >u2 and <u2
+    return (len(array.shape) == 5
+            and array.dtype == numpy.dtype(dtype)
+            and array.chunks == (1, 1, 1, tile_size, tile_size)
+            and compressor is not None
+            and compressor.codec_id == "blosc"
+            and compressor.get_config().get("cname") == "zstd"
+            and not array.filters
+            and array.order == "C"
+            and array.fill_value == fill_value)
+
+
+def _join(path, key):
+    return path + "/" + key if path else key
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import base64
+import logging
+
+import boto3
+import botocore
+
+from minerva_cli.util.configurer import Configurer
+
+logger = logging.getLogger("minerva")
+
+# Tokens are refreshed when they expire within this many seconds
+EXPIRY_MARGIN = 300
+
+
+class TokenCache:
+    """
+    Caches Cognito tokens between CLI invocations in a file readable only by the current user.
+    Tokens are stored per endpoint, client id and username.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def restore(self, client, username):
+        """
+        Sets cached tokens into the client, refreshing the id token if it has expired.
+        Returns False if there are no usable tokens, and the client has to authenticate with a password.
+        """
+        entry = self._load().get(self._key(client, username))
+        if entry is None:
+            return False
+
+        if entry["expires"] - EXPIRY_MARGIN > time.time():
+            logger.debug("Using cached token for %s", username)
+            self._set_tokens(client, entry)
+            return True
+
+        if not entry.get("refresh_token"):
+            return False
+
+        try:
+            logger.debug("Refreshing cached token for %s", username)
+            result = self._refresh(client, entry["refresh_token"])
+        except Exception as e:
+            logger.debug("Refreshing token failed: %s", e)
+            return False
+
+        entry["id_token"] = result["IdToken"]
+        entry["token_type"] = result["TokenType"]
+        entry["refresh_token"] = result.get("RefreshToken", entry["refresh_token"])
+        entry["expires"] = _token_expiration(entry["id_token"])
+        self._set_tokens(client, entry)
+        self.store(client, username)
+        return True
+
+    def store(self, client, username):
+        entries = self._load()
+        entries[self._key(client, username)] = {
+            "id_token": client.id_token,
+            "token_type": client.token_type,
+            "refresh_token": client.refresh_token,
+            "expires": _token_expiration(client.id_token)
+        }
+        self._save(entries)
+
+    def invalidate(self, client, username):
+        """
+        Removes the cached tokens of the user, e.g. when the API has rejected them.
+        """
+        entries = self._load()
+        if entries.pop(self._key(client, username), None) is not None:
+            logger.debug("Removing cached token for %s", username)
+            self._save(entries)
+
+    def _save(self, entries):
+        # Written into a temporary file first, so that concurrent CLI processes never read a partial file
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        try:
+            with Configurer.open_private(tmp_path) as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not write token cache %s: %s", self.path, e)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring invalid token cache %s: %s", self.path, e)
+            return {}
+
+    def _refresh(self, client, refresh_token):
+        config = botocore.config.Config(signature_version=botocore.UNSIGNED, region_name=client.region)
+        cognito = boto3.client('cognito-idp', config=config)
+        response = cognito.initiate_auth(
+            AuthFlow='REFRESH_TOKEN_AUTH',
+            AuthParameters={
+                'REFRESH_TOKEN': refresh_token
+            },
+            ClientId=client.cognito_client_id
+        )
+        return response["AuthenticationResult"]
+
+    @staticmethod
+    def _set_tokens(client, entry):
+        client.id_token = entry["id_token"]
+        client.token_type = entry["token_type"]
+        client.refresh_token = entry["refresh_token"]
+
+    @staticmethod
+    def _key(client, username):
+        return "{}|{}|{}".format(client.endpoint, client.cognito_client_id, username)
+
+
+def token_claims(id_token):
+    """
+    Reads the claims from the JWT payload. The signature is not verified, the claims are
+    only used to decide when to refresh the token and to identify the user in local caches.
+    """
+    try:
+        payload = id_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except (AttributeError, IndexError, ValueError):
+        return {}
+
+
+def expires_soon(id_token):
+    """
+    Whether the token has expired, or expires within EXPIRY_MARGIN seconds.
+    """
+    return _token_expiration(id_token) - EXPIRY_MARGIN <= time.time()
+
+
+def _token_expiration(id_token):
+    return token_claims(id_token).get("exp", 0)
@@ -0,0 +1,291 @@
+import time
+import random
+import logging
+import threading
+import builtins
+from collections.abc import MutableMapping
+
+from minerva_cli.util.profiler import stage
+
+logger = logging.getLogger("minerva")
+
+DEFAULT_MAX_RETRIES = 8
+# While limited, concurrency is raised when a window of requests is not this much slower than the previous one,
+# and lowered when it is
+PROBE_GAIN = 0.05
+THROTTLE_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests",
+                  "RequestThrottled", "ServiceUnavailable"}
+
+THROTTLED = "throttled"
+RETRY = "retry"
+
+
+class TransferScheduler:
+    """
+    Schedules the S3 requests of imports and exports. Each request runs in the thread which calls
+    run(), so the thread pools of the callers (--concurrency, --upload-concurrency, --part-concurrency)
+    set the most requests in flight, or max_concurrency if it is given. Below that, the number of
+    requests in flight is tuned by additive increase / multiplicative decrease: it is halved when S3
+    throttles the requests (503 SlowDown), then grows by one per window of requests while the
+    throughput does not drop, until the callers' limit is reached again. max_bandwidth caps the
+    transfer rate in bytes per second. Throttled and failed requests are retried with jittered
+    exponential backoff, and retries and throttling events are counted for the summary.
+
+    A TransferScheduler can be sent to worker processes; the copy starts with the same settings
+    and empty counters.
+    """
+
+    def __init__(self, max_bandwidth=None, max_concurrency=None, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=0.1, max_delay=20, profiler=None):
+        self.max_bandwidth = max_bandwidth
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.profiler = profiler
+        # None while only the callers limit the requests in flight
+        self.limit = max_concurrency
+        self.peak = 0
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._next_start = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._window_bytes = 0
+        self._rate = None
+        self._last_decrease = 0
+        self._start = time.monotonic()
+
+    def __getstate__(self):
+        return {"max_bandwidth": self.max_bandwidth, "max_concurrency": self.max_concurrency, "max_retries": self.max_retries,
+                "base_delay": self.base_delay, "max_delay": self.max_delay, "profiler": self.profiler}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def share(self, parts):
+        """
+        Returns a scheduler for one of parts worker processes, with an equal share of the bandwidth.
+        """
+        state = self.__getstate__()
+        if self.max_bandwidth:
+            state["max_bandwidth"] = max(1, self.max_bandwidth // parts)
+        return TransferScheduler(**state)
+
+    def run(self, function, num_bytes=0):
+        """
+        Calls function, which makes one S3 request transferring about num_bytes, and returns its result.
+        """
+        attempt = 0
+        while True:
+            self._reserve_bandwidth(num_bytes)
+            self._acquire()
+            start = time.monotonic()
+            try:
+                result = function()
+            except Exception as e:
+                self._release()
+                kind = _classify(e)
+                if kind == THROTTLED:
+                    self._throttled()
+                if kind is None or attempt >= self.max_retries:
+                    with self._condition:
+                        self.failed += 1
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.debug("Retrying S3 request in %.2f s (%s): %s", delay, kind, e)
+                with self._condition:
+                    self.retries += 1
+                with stage(self.profiler, "transfer backoff"):
+                    time.sleep(delay)
+                continue
+            self._release()
+            self._completed(num_bytes, time.monotonic() - start)
+            return result
+
+    def summary(self):
+        with self._condition:
+            elapsed = max(time.monotonic() - self._start, 1e-6)
+            return {
+                "requests": self.requests,
+                "bytes": self.bytes,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "concurrency": self.limit,
+                "peak concurrency": self.peak,
+                "MB/s": round(self.bytes / 1e6 / elapsed, 2)
+            }
+
+    def merge(self, summary):
+        """
+        Adds the counters of a scheduler which ran in a worker process.
+        """
+        with self._condition:
+            for key in ("requests", "bytes", "retries", "throttled", "failed"):
+                setattr(self, key, getattr(self, key) + summary[key])
+            self.peak = max(self.peak, summary["peak concurrency"])
+
+    def report(self):
+        summary = self.summary()
+        return ("S3 requests: {} ({:.1f} MB), {} retries, {} throttled, {} failed, up to {} in flight{}"
+                .format(summary["requests"], summary["bytes"] / 1e6, summary["retries"], summary["throttled"],
+                        summary["failed"], summary["peak concurrency"],
+                        "" if summary["concurrency"] is None else ", limited to {}".format(summary["concurrency"])))
+
+    def _reserve_bandwidth(self, num_bytes):
+        # Requests are started at the pace at which their bytes fit into the bandwidth
+        if not self.max_bandwidth or not num_bytes:
+            return
+        with self._condition:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + num_bytes / self.max_bandwidth
+        if start > now:
+            with stage(self.profiler, "transfer bandwidth wait"):
+                time.sleep(start - now)
+
+    def _acquire(self):
+        with self._condition:
+            if self._is_full():
+                with stage(self.profiler, "transfer slot wait"):
+                    while self._is_full():
+                        self._condition.wait()
+            self._in_flight += 1
+            self.peak = max(self.peak, self._in_flight)
+
+    def _is_full(self):
+        return self.limit is not None and self._in_flight >= self.limit
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def _completed(self, num_bytes, seconds):
+        with self._condition:
+            self.requests += 1
+            self.bytes += num_bytes
+            if self.limit is None:
+                return
+            self._window_requests += 1
+            self._window_bytes += num_bytes
+            if self._window_requests < self.limit:
+                return
+
+            # One window is as many requests as are allowed in flight
+            now = time.monotonic()
+            rate = (self._window_bytes or self._window_requests) / max(now - self._window_start, 1e-6)
+            if self._rate is not None and rate < self._rate * (1 - PROBE_GAIN):
+                self._set_limit(self.limit - 1)
+            else:
+                self._set_limit(self.limit + 1)
+            self._rate = rate
+            self._window_start = now
+            self._window_requests = 0
+            self._window_bytes = 0
+
+    def _throttled(self):
+        with self._condition:
+            self.throttled += 1
+            now = time.monotonic()
+            # Requests in flight when S3 started throttling fail together, so they count as one event
+            if now - self._last_decrease < self.base_delay * 10:
+                return
+            self._last_decrease = now
+            self._set_limit((self.limit if self.limit is not None else self.peak) // 2)
+            self._rate = None
+            self._window_start = now
+            self._window_requests = 0
+            self._window_bytes = 0
+
+    def _set_limit(self, limit):
+        limit = max(1, limit)
+        ceiling = self.max_concurrency or self.peak
+        if limit >= ceiling:
+            # Back at the limit of the callers
+            limit = self.max_concurrency
+        if limit != self.limit:
+            logger.debug("S3 request concurrency %s -> %s", self.limit or "unlimited", limit or "unlimited")
+        self.limit = limit
+        self._condition.notify_all()
+
+
+def run(transfer, function, num_bytes=0):
+    """
+    Runs an S3 request through the scheduler, or directly if transfer is None.
+    """
+    if transfer is None:
+        return function()
+    return transfer.run(function, num_bytes)
+
+
+def botocore_config(transfer, **kwargs):
+    """
+    Returns a botocore Config for S3 clients whose requests go through the scheduler. Botocore's
+    own retries are turned off, so that the scheduler sees the throttling responses.
+    """
+    from botocore.config import Config
+
+    if transfer is not None:
+        kwargs["retries"] = {"max_attempts": 0}
+    return Config(**kwargs)
+
+
+class ScheduledStore(MutableMapping):
+    """
+    Zarr store which writes the encoded chunks into the wrapped store (e.g. s3fs.S3Map) through the scheduler.
+    Reads, which are only metadata during an import, go to the wrapped store directly.
+    """
+
+    def __init__(self, store, transfer):
+        self.store = store
+        self.transfer = transfer
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        self.transfer.run(lambda: self.store.__setitem__(key, value), len(value))
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def _classify(error):
+    """
+    Returns THROTTLED for throttling responses, RETRY for other transient errors, or None.
+    Errors wrapped by other libraries (e.g. s3fs) are recognized by their cause.
+    """
+    from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotocoreConnectionError
+
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, ClientError):
+            code = error.response.get("Error", {}).get("Code")
+            status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if code in THROTTLE_CODES or status in (429, 503):
+                return THROTTLED
+            if (status is not None and status >= 500) or code in ("InternalError", "RequestTimeout"):
+                return RETRY
+            return None
+        if isinstance(error, (HTTPClientError, BotocoreConnectionError, builtins.ConnectionError, TimeoutError)):
+            return RETRY
+        error = error.__cause__ or error.__context__
+    return None
@@ -0,0 +1,16 @@
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Parses a human readable size, e.g. "500M" or "4G", into bytes.
+    """
+    if value is None:
+        return None
+    value = str(value).strip().upper().rstrip("B")
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+    number = value[:-1] if unit else value
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError("Invalid size: {}".format(value))
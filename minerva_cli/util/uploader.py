@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import math
+import hashlib
+import logging
+import time
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+from requests.exceptions import HTTPError
+from minerva_lib.importing import MinervaImporter
+from minerva_lib.util.fileutils import FileUtils
+from minerva_lib.util.progress import ProgressPercentage
+
+from minerva_cli.util.configurer import Configurer
+from minerva_cli.util.profiler import stage
+from minerva_cli.util.transfer import run, botocore_config
+
+logger = logging.getLogger("minerva")
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_PART_CONCURRENCY = 8
+MAX_PARTS = 10000
+# Credentials are refreshed when they expire within this many seconds
+CREDENTIALS_MARGIN = 300
+# Seconds to wait for the uploaded files to be synced, and again for the filesets to be extracted
+IMPORT_TIMEOUT = 1800
+
+
+class UploadState:
+    """
+    Persists unfinished imports and multipart upload ids, so that an interrupted
+    import can continue uploading into the same import where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = {"imports": {}, "uploads": {}}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring invalid upload state %s: %s", path, e)
+
+    def get_import(self, key):
+        return self.state["imports"].get(key)
+
+    def set_import(self, key, import_uuid):
+        with self._lock:
+            if import_uuid is None:
+                self.state["imports"].pop(key, None)
+            else:
+                self.state["imports"][key] = import_uuid
+            self._save()
+
+    def get_upload(self, bucket, key):
+        return self.state["uploads"].get(bucket + "/" + key)
+
+    def set_upload(self, bucket, key, upload):
+        with self._lock:
+            if upload is None:
+                self.state["uploads"].pop(bucket + "/" + key, None)
+            else:
+                self.state["uploads"][bucket + "/" + key] = upload
+            self._save()
+
+    def _save(self):
+        with Configurer.open_private(self.path) as f:
+            json.dump(self.state, f)
+
+
+class MultipartUploader:
+    """
+    Uploads large files as multipart uploads, with the parts of all files sharing one pool of
+    part_concurrency threads. Upload ids are persisted in UploadState, and parts which were
+    uploaded before an interruption are not uploaded again. Temporary credentials are refreshed
+    through credentials_provider before they expire. Requests go through the TransferScheduler
+    transfer, if one is given.
+    """
+
+    def __init__(self, region, state, part_size=DEFAULT_PART_SIZE, part_concurrency=DEFAULT_PART_CONCURRENCY, credentials_provider=None,
+                 profiler=None, transfer=None):
+        self.region = region
+        self.state = state
+        self.part_size = part_size
+        self.part_concurrency = part_concurrency
+        self.credentials_provider = credentials_provider
+        self.profiler = profiler
+        self.transfer = transfer
+        self.failed = []
+        self._credentials = None
+        self._s3 = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=part_concurrency)
+
+    def upload_file(self, filepath, bucket, object_name, credentials, callback=None):
+        try:
+            logger.info("Uploading file %s", filepath)
+            size = os.path.getsize(filepath)
+            if size <= self.part_size:
+                with stage(self.profiler, "upload file", size):
+                    run(self.transfer, lambda: self._client(credentials).upload_file(filepath, bucket, object_name, Callback=callback),
+                        size)
+            else:
+                self._upload_multipart(filepath, size, bucket, object_name, credentials, callback)
+        except Exception as e:
+            logger.error("Uploading %s failed: %s", filepath, e)
+            self.failed.append(filepath)
+
+    def _upload_multipart(self, filepath, size, bucket, key, credentials, callback):
+        part_size = max(self.part_size, math.ceil(size / MAX_PARTS))
+        num_parts = math.ceil(size / part_size)
+        mtime = os.path.getmtime(filepath)
+        upload = self.state.get_upload(bucket, key)
+        uploaded = {}
+        if upload is not None:
+            if (upload["path"], upload["size"], upload["mtime"], upload["part_size"]) == (filepath, size, mtime, part_size):
+                uploaded = self._list_parts(credentials, bucket, key, upload["upload_id"])
+                if uploaded is None:
+                    # The upload has been aborted or completed, start from the beginning
+                    upload = None
+                    uploaded = {}
+                else:
+                    logger.info("Resuming upload of %s, %s of %s parts already uploaded", filepath, len(uploaded), num_parts)
+            else:
+                self._abort(credentials, bucket, key, upload["upload_id"])
+                upload = None
+
+        if upload is None:
+            response = run(self.transfer, lambda: self._client(credentials).create_multipart_upload(Bucket=bucket, Key=key))
+            upload = {"upload_id": response["UploadId"], "path": filepath, "size": size, "mtime": mtime, "part_size": part_size}
+            self.state.set_upload(bucket, key, upload)
+
+        def upload_part(part_number):
+            with stage(self.profiler, "read part"):
+                with open(filepath, "rb") as f:
+                    f.seek((part_number - 1) * part_size)
+                    data = f.read(part_size)
+            with stage(self.profiler, "upload part", len(data)):
+                response = run(self.transfer,
+                               lambda: self._client(credentials).upload_part(Bucket=bucket, Key=key, UploadId=upload["upload_id"],
+                                                                             PartNumber=part_number, Body=data),
+                               len(data))
+            if callback is not None:
+                callback(len(data))
+            return response["ETag"]
+
+        futures = {}
+        for part_number in range(1, num_parts + 1):
+            if part_number in uploaded:
+                if callback is not None:
+                    callback(min(part_size, size - (part_number - 1) * part_size))
+            else:
+                futures[part_number] = self._executor.submit(upload_part, part_number)
+
+        for part_number, future in futures.items():
+            uploaded[part_number] = future.result()
+
+        parts = [{"PartNumber": number, "ETag": uploaded[number]} for number in sorted(uploaded)]
+        run(self.transfer, lambda: self._client(credentials).complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload["upload_id"],
+                                                                                     MultipartUpload={"Parts": parts}))
+        self.state.set_upload(bucket, key, None)
+
+    def _list_parts(self, credentials, bucket, key, upload_id):
+        parts = {}
+        args = {"Bucket": bucket, "Key": key, "UploadId": upload_id}
+        try:
+            while True:
+                response = self._client(credentials).list_parts(**args)
+                for part in response.get("Parts", []):
+                    parts[part["PartNumber"]] = part["ETag"]
+                if not response.get("IsTruncated"):
+                    return parts
+                args["PartNumberMarker"] = response["NextPartNumberMarker"]
+        except ClientError as e:
+            logger.debug("Listing parts of %s failed: %s", key, e)
+            return None
+
+    def _abort(self, credentials, bucket, key, upload_id):
+        try:
+            self._client(credentials).abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            logger.debug("Aborting upload of %s failed: %s", key, e)
+        self.state.set_upload(bucket, key, None)
+
+    def _client(self, credentials):
+        """
+        Returns an S3 client shared by all upload threads, recreated when the credentials are refreshed.
+        """
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = credentials
+            if self.credentials_provider is not None and _expires_soon(self._credentials):
+                logger.debug("Refreshing import credentials")
+                self._credentials = self.credentials_provider()
+                self._s3 = None
+            if self._s3 is None:
+                self._s3 = boto3.client("s3", aws_access_key_id=self._credentials["AccessKeyId"],
+                                        aws_secret_access_key=self._credentials["SecretAccessKey"],
+                                        aws_session_token=self._credentials["SessionToken"],
+                                        region_name=self.region,
+                                        config=botocore_config(self.transfer, max_pool_connections=self.part_concurrency))
+            return self._s3
+
+
+class BatchImporter(MinervaImporter):
+    """
+    MinervaImporter which continues an unfinished import of the same files into the same repository,
+    if one was interrupted, and lets the uploader refresh the import credentials. Imports are keyed by
+    the files too, because jobs of a manifest may import other files into the same repository at once.
+    Upload and processing progress is written to output, as jobs run in threads of one process.
+    """
+
+    def __init__(self, minerva_client, uploader, state, dryrun=False, output=None):
+        super().__init__(minerva_client, uploader=uploader, dryrun=dryrun)
+        self.state = state
+        self.output = output or sys.stdout
+        self.files = []
+        self.import_key = None
+
+    def import_files(self, files, repository=None, archive=False):
+        self.files = files
+        import_uuid = super().import_files(files, repository=repository, archive=archive)
+        self.state.set_import(self.import_key, None)
+        return import_uuid
+
+    def _create_import(self, repository_uuid):
+        self.import_key = _import_key(repository_uuid, self.files)
+        import_uuid = self.state.get_import(self.import_key)
+        if import_uuid is not None:
+            try:
+                super()._get_import_credentials(import_uuid)
+                logger.info("Continuing unfinished import %s", import_uuid)
+                return import_uuid
+            except HTTPError as e:
+                logger.warning("Cannot continue unfinished import %s: %s", import_uuid, e)
+
+        import_uuid = super()._create_import(repository_uuid)
+        self.state.set_import(self.import_key, import_uuid)
+        return import_uuid
+
+    def _get_import_credentials(self, import_uuid):
+        credentials, bucket, prefix = super()._get_import_credentials(import_uuid)
+        self.uploader.credentials_provider = lambda: super(BatchImporter, self)._get_import_credentials(import_uuid)[0]
+        return credentials, bucket, prefix
+
+    def _upload_raw_files(self, files, bucket, prefix, credentials):
+        progress = _UploadProgress(self.output)
+        for file in files:
+            progress.add(file)
+        with ThreadPoolExecutor() as executor:
+            for file in files:
+                executor.submit(self.uploader.upload_file, file, bucket, prefix + FileUtils.get_key(file), credentials, progress)
+        self.output.write("\r\n")
+        if self.uploader.failed:
+            raise IOError("Uploading {} files failed, run the import again to resume".format(len(self.uploader.failed)))
+
+    def poll_import_progress(self, import_uuid):
+        """
+        Waits until the filesets of the import have been processed, like MinervaImporter.poll_import_progress.
+        """
+        timeout = IMPORT_TIMEOUT
+        timeout_extended = False
+        start = time.time()
+        logger.info("Please wait while filesets are created...")
+        while True:
+            filesets = self.minerva_client.list_filesets_in_import(import_uuid)["data"]
+            if len(filesets) > 0:
+                if not timeout_extended:
+                    # Extracting the filesets may take as long again
+                    timeout_extended = True
+                    timeout += IMPORT_TIMEOUT
+                self.output.write("\rProcessing filesets: " + " ".join(
+                    "{} {}%".format(fileset["name"], fileset["progress"] or 0) for fileset in filesets) + " ")
+                self.output.flush()
+                if all(fileset["complete"] for fileset in filesets):
+                    return
+
+            if time.time() - start > timeout:
+                logger.warning("Waiting for import timed out!")
+                logger.warning("This does not necessarily mean that import failed, it could just take longer than expected.")
+                logger.warning("To check fileset progress, run command:")
+                logger.warning("minerva status")
+                return
+            time.sleep(2)
+
+
+class _UploadProgress(ProgressPercentage):
+    """
+    ProgressPercentage which writes to the given stream instead of sys.stdout.
+    """
+
+    def __init__(self, output):
+        super().__init__()
+        self.output = output
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self._seen_so_far += bytes_amount
+            percentage = self._seen_so_far / max(self._total_size, 1) * 100
+            self.output.write("\r%s MB / %s MB (%.1f%%)" % (self._seen_so_far // 1000000, self._total_size // 1000000, percentage))
+            self.output.flush()
+
+
+def _import_key(repository_uuid, files):
+    paths = sorted(os.path.abspath(file) for file in files)
+    return repository_uuid + "/" + hashlib.sha256("\n".join(paths).encode("utf-8")).hexdigest()
+
+
+def _expires_soon(credentials):
+    expiration = credentials.get("Expiration")
+    if not expiration:
+        return False
+    if isinstance(expiration, str):
+        expiration = datetime.fromisoformat(expiration.replace("Z", "+00:00"))
+    return (expiration - datetime.now(timezone.utc)).total_seconds() < CREDENTIALS_MARGIN
@@ -0,0 +1,66 @@
+import time
+import logging
+
+from tqdm import tqdm
+
+logger = logging.getLogger("minerva")
+
+MIN_INTERVAL = 2
+MAX_INTERVAL = 60
+BACKOFF = 1.5
+
+
+class ImportWatcher:
+    """
+    Follows the progress of all incomplete imports with one request per tick, showing a
+    progress bar per fileset. The polling interval grows while nothing changes,
+    and is reset as soon as any fileset makes progress.
+    """
+
+    def __init__(self, client, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.bars = {}
+        self.progress = {}
+
+    def watch(self):
+        interval = self.min_interval
+        try:
+            while True:
+                result = self.client.list_incomplete_imports()
+                filesets = result.get("included", {}).get("filesets", [])
+                changed = self._update(filesets)
+                if len(result["data"]) == 0:
+                    logger.info("All imports have completed.")
+                    return
+                interval = self.min_interval if changed else min(interval * BACKOFF, self.max_interval)
+                logger.debug("Watching %s imports, next poll in %.1f s", len(result["data"]), interval)
+                time.sleep(interval)
+        finally:
+            for bar in self.bars.values():
+                bar.close()
+
+    def _update(self, filesets):
+        changed = False
+        current = set()
+        for fileset in filesets:
+            uuid = fileset["uuid"]
+            current.add(uuid)
+            progress = fileset.get("progress") or 0
+            if uuid not in self.bars:
+                self.bars[uuid] = tqdm(total=100, unit="%", desc=fileset.get("name", uuid), position=len(self.bars))
+                self.progress[uuid] = 0
+                changed = True
+            if progress != self.progress[uuid]:
+                self.bars[uuid].update(progress - self.progress[uuid])
+                self.progress[uuid] = progress
+                changed = True
+
+        # Filesets which are no longer listed as incomplete have finished
+        for uuid in list(self.bars):
+            if uuid not in current and self.progress[uuid] < 100:
+                self.bars[uuid].update(100 - self.progress[uuid])
+                self.progress[uuid] = 100
+                changed = True
+        return changed
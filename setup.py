@@ -26,7 +26,12 @@ setuptools.setup(
         "requests",
         "tabulate",
         "minerva-lib==0.0.5",
-        "tqdm"
+        "tqdm",
+        "numpy>=1.18",
+        "tifffile>=2020.11.26",
+        "zarr>=2.6.1",
+        "numcodecs>=0.6.4",
+        "s3fs>=0.4.2"
     ],
     dependency_links=[
         'git+https://github.com/labsyspharm/minerva-lib-python@master#egg=minerva-lib'
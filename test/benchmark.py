@@ -0,0 +1,212 @@
+"""
+End-to-end performance benchmark for the Minerva CLI.
+
+Runs the CLI commands against a local stand-in of the Minerva backend (test/fake_minerva.py)
+and a local S3-compatible object store, using synthetic OME-TIFFs of the given sizes.
+Reports seconds, tiles/s and MB/s for each scenario. Results can be saved as JSON,
+and compared against a saved baseline to catch regressions before a release.
+
+Requires moto (pip install "moto[server]") in addition to the CLI dependencies.
+
+Usage: python -m test.benchmark [--sizes 2048,4096] [--channels 4] [--latency-ms 0]
+                                [--error-rate 0] [--json results.json] [--baseline baseline.json]
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import tifffile
+
+from minerva_cli.minerva import Configuration, execute_command
+from minerva_cli.util.output import print_table
+from minerva_cli.util.uploader import UploadState, DEFAULT_PART_SIZE, DEFAULT_PART_CONCURRENCY
+from test.fake_minerva import FakeMinervaServer, LocalS3, TILE_BUCKET
+
+REPOSITORY = "benchmark"
+LISTING_REPOSITORY = "benchmark-listing"
+TIFF_TILE_SIZE = 256
+MB = 1024 * 1024
+
+
+def synthetic_ome_tiff(path, size, channels):
+    """
+    Writes a pyramidal OME-TIFF of size x size pixels, with levels down to 1024 pixels
+    and at least two levels.
+    """
+    rng = numpy.random.default_rng(size)
+    # Smooth gradients with noise compress roughly like real images, unlike pure noise
+    gradient = numpy.add.outer(numpy.arange(size), numpy.arange(size)).astype(numpy.uint16)
+    data = numpy.stack([gradient + rng.integers(0, 256, (size, size), dtype=numpy.uint16) for _ in range(channels)])
+    levels = max(2, math.ceil(math.log2(size / 1024)) + 1)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.save(data, tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE), subifds=levels - 1, metadata={"axes": "CYX"})
+        for _ in range(1, levels):
+            data = data[:, ::2, ::2]
+            tif.save(data, tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE), subfiletype=1)
+
+
+def tile_usage(s3, prefix):
+    """
+    Returns the number of zarr chunks and their total size under prefix in the tile bucket.
+    """
+    tiles = 0
+    size = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=TILE_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            name = obj["Key"].rsplit("/", 1)[-1]
+            if not name.startswith(".") and name != "metadata.xml":
+                tiles += 1
+                size += obj["Size"]
+    return tiles, size
+
+
+def run_scenario(name, command, client, cfg):
+    start = time.perf_counter()
+    try:
+        # Tables and progress output of the commands would drown the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            status = "ok" if execute_command(command, client, cfg) == 0 else "failed"
+    except Exception as e:
+        logging.error("Scenario %s failed: %s", name, e)
+        status = "failed"
+    seconds = time.perf_counter() - start
+    return seconds, status
+
+
+def result(name, seconds, status, tiles=None, size=None):
+    if status != "ok":
+        tiles = size = None
+    return {
+        "scenario": name,
+        "status": status,
+        "seconds": round(seconds, 2),
+        "tiles": tiles,
+        "MB": round(size / MB, 1) if size is not None else None,
+        "tiles/s": round(tiles / seconds, 1) if tiles is not None else None,
+        "MB/s": round(size / MB / seconds, 1) if size is not None else None
+    }
+
+
+def run_benchmark(args, workdir):
+    s3_server = LocalS3().start()
+    server = FakeMinervaServer(s3=s3_server.client(), latency=args.latency_ms / 1000,
+                               error_rate=args.error_rate).start()
+    client = server.client()
+    s3 = s3_server.client()
+    results = []
+    try:
+        for size in args.sizes:
+            directory = os.path.join(workdir, str(size))
+            os.makedirs(directory)
+            path = os.path.join(directory, "synthetic-{}.ome.tif".format(size))
+            synthetic_ome_tiff(path, size, args.channels)
+            file_size = os.path.getsize(path)
+
+            cfg = Configuration(repository=REPOSITORY, file=path, local_import=True, workers=args.workers)
+            seconds, status = run_scenario("import --local", "import", client, cfg)
+            image_uuid = next((image["uuid"] for image in server.images.values()
+                               if image["name"] == os.path.basename(path)), None)
+            tiles, tile_size = tile_usage(s3, image_uuid) if image_uuid else (0, 0)
+            results.append(result("import --local {}px".format(size), seconds, status, tiles, file_size))
+
+            cfg = Configuration(repository=REPOSITORY, file=path,
+                                upload_state=UploadState(os.path.join(workdir, "uploads.json")),
+                                part_size=DEFAULT_PART_SIZE, part_concurrency=DEFAULT_PART_CONCURRENCY)
+            seconds, status = run_scenario("import", "import", client, cfg)
+            results.append(result("import {}px".format(size), seconds, status, size=file_size))
+
+            if results[-2]["status"] != "ok":
+                continue
+            for export_format in ("zarr", "tif"):
+                output = os.path.join(workdir, "export-{}.{}".format(size, export_format))
+                cfg = Configuration(image_uuid=image_uuid, output=output, export_format=export_format,
+                                    save_pyramid=True, concurrency=args.concurrency)
+                seconds, status = run_scenario("export", "export", client, cfg)
+                results.append(result("export {} {}px".format(export_format, size), seconds, status, tiles, tile_size))
+
+        repository_uuid = server.add_repository(LISTING_REPOSITORY)
+        for index in range(args.images):
+            server.add_image(repository_uuid, "image-{}".format(index))
+        seconds, status = run_scenario("images", "images", client, Configuration(repository=LISTING_REPOSITORY))
+        results.append(result("images ({} rows)".format(args.images), seconds, status))
+        seconds, status = run_scenario("repositories", "repositories", client, Configuration())
+        results.append(result("repositories", seconds, status))
+    finally:
+        server.stop()
+        s3_server.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the scenarios which are slower than in the baseline by more than tolerance.
+    """
+    previous = {row["scenario"]: row for row in baseline}
+    regressions = []
+    for row in results:
+        before = previous.get(row["scenario"])
+        if before is None or row["status"] != "ok":
+            continue
+        if row["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append("{}: {:.2f} s, baseline {:.2f} s".format(row["scenario"], row["seconds"], before["seconds"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Minerva CLI against a local stand-in backend")
+    parser.add_argument("--sizes", default="2048,4096", type=lambda value: [int(size) for size in value.split(",")],
+                        help="Comma separated image widths and heights in pixels")
+    parser.add_argument("--channels", type=int, default=4, help="Number of channels in the synthetic images")
+    parser.add_argument("--images", type=int, default=2000, help="Number of images in the listing benchmark")
+    parser.add_argument("--workers", type=int, default=1, help="Local import workers")
+    parser.add_argument("--concurrency", type=int, default=10, help="Export download concurrency")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added to every API request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of API requests which fail with HTTP 503")
+    parser.add_argument("--json", help="Save the results as JSON into this file")
+    parser.add_argument("--baseline", help="Compare against results saved earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown compared to the baseline")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic images and exports")
+    args = parser.parse_args()
+
+    # minerva_cli.minerva configures logging into stdout when imported
+    for handler in logging.getLogger().handlers:
+        handler.setStream(sys.stderr)
+    for name in ("", "minerva", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="minerva-benchmark-")
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        if args.keep:
+            print("Benchmark files kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = any(row["status"] != "ok" for row in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        failed = failed or len(regressions) > 0
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Local stand-in for the Minerva backend, for benchmarks and manual testing.
+
+FakeMinervaServer implements the REST endpoints used by Minerva CLI in memory, with
+configurable latency and error injection. LocalS3 runs a local S3-compatible object store
+(moto server), and points boto3/s3fs to it through AWS_ENDPOINT_URL_S3.
+"""
+import os
+import re
+import math
+import json
+import time
+import uuid
+import base64
+import random
+import socket
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import boto3
+
+RAW_BUCKET = "minerva-local-rawbucket"
+TILE_BUCKET = "minerva-local-tilebucket"
+FAKE_CREDENTIALS = {
+    "AccessKeyId": "FakeAccessKeyId",
+    "SecretAccessKey": "FakeSecretAccessKey",
+    "SessionToken": "FakeSessionToken",
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_id_token(username="benchmark", lifetime=3600):
+    """
+    Returns an unsigned JWT, which is enough for the CLI to read the expiration and user.
+    """
+    def encode(claims):
+        return base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    claims = {"sub": username, "cognito:username": username, "exp": int(time.time()) + lifetime}
+    return encode({"alg": "none"}) + "." + encode(claims) + ".signature"
+
+
+class LocalS3:
+    """
+    Local S3-compatible object store backed by moto, which has to be installed separately.
+    """
+
+    def __init__(self):
+        from moto.server import ThreadedMotoServer
+
+        self.port = _free_port()
+        self.server = ThreadedMotoServer(ip_address="127.0.0.1", port=self.port, verbose=False)
+        self.endpoint = "http://127.0.0.1:{}".format(self.port)
+        self._environ = {}
+
+    def start(self):
+        self.server.start()
+        environment = {
+            "AWS_ENDPOINT_URL_S3": self.endpoint,
+            "AWS_ACCESS_KEY_ID": FAKE_CREDENTIALS["AccessKeyId"],
+            "AWS_SECRET_ACCESS_KEY": FAKE_CREDENTIALS["SecretAccessKey"],
+        }
+        for key, value in environment.items():
+            self._environ[key] = os.environ.get(key)
+            os.environ[key] = value
+
+        s3 = self.client()
+        for bucket in (RAW_BUCKET, TILE_BUCKET):
+            s3.create_bucket(Bucket=bucket)
+        return self
+
+    def client(self):
+        return boto3.client("s3", endpoint_url=self.endpoint, region_name="us-east-1")
+
+    def stop(self):
+        self.server.stop()
+        for key, value in self._environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+class FakeMinervaServer:
+    """
+    In-memory Minerva API. Every request is delayed by latency seconds, and fails with
+    HTTP 503 with probability error_rate. Uploaded raw files become filesets, which are
+    complete after they have been polled processing_polls times.
+    """
+
+    def __init__(self, s3=None, latency=0.0, error_rate=0.0, processing_polls=2):
+        self.s3 = s3
+        self.latency = latency
+        self.error_rate = error_rate
+        self.processing_polls = processing_polls
+        self.repositories = {}
+        self.imports = {}
+        self.filesets = {}
+        self.images = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.port = _free_port()
+        self.endpoint = "http://127.0.0.1:{}".format(self.port)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def client(self):
+        """
+        Returns an authenticated MinervaClient connected to this server.
+        """
+        from minerva_lib.client import MinervaClient
+
+        client = MinervaClient(endpoint=self.endpoint, region="us-east-1", cognito_client_id="local")
+        client.id_token = fake_id_token()
+        client.token_type = "Bearer"
+        client.refresh_token = "local"
+        return client
+
+    def add_repository(self, name):
+        repository_uuid = str(uuid.uuid4())
+        self.repositories[repository_uuid] = {"uuid": repository_uuid, "name": name, "raw_storage": "Destroy"}
+        return repository_uuid
+
+    def add_image(self, repository_uuid, name, pyramid_levels=1, tile_size=1024, format="zarr"):
+        image_uuid = str(uuid.uuid4())
+        self.images[image_uuid] = {
+            "uuid": image_uuid,
+            "name": name,
+            "repository_uuid": repository_uuid,
+            "pyramid_levels": pyramid_levels,
+            "tile_size": tile_size,
+            "format": format,
+            "fileset_uuid": None,
+            "deleted": False
+        }
+        return image_uuid
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def do_PUT(self):
+                self._dispatch("PUT")
+
+            def _dispatch(self, method):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.error_rate and random.random() < server.error_rate:
+                    return self._send(503, {"error": "Injected error"})
+
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                try:
+                    with server._lock:
+                        status, response, headers = server._route(method, url.path, parse_qs(url.query), body, self.headers)
+                except KeyError as e:
+                    status, response, headers = 404, {"error": "Not found: {}".format(e)}, {}
+                except Exception as e:
+                    logging.exception("Fake Minerva request failed")
+                    status, response, headers = 500, {"error": str(e)}, {}
+                self._send(status, response, headers)
+
+            def _send(self, status, response, headers=None):
+                data = response if isinstance(response, bytes) else json.dumps(response).encode()
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _route(self, method, path, query, body, headers):
+        routes = [
+            ("GET", r"/repository", self._list_repositories),
+            ("POST", r"/repository", self._create_repository),
+            ("GET", r"/repository/([^/]+)/images", self._list_images_in_repository),
+            ("POST", r"/import", self._create_import),
+            ("GET", r"/import/incomplete", self._list_incomplete_imports),
+            ("GET", r"/import/([^/]+)/credentials", self._import_credentials),
+            ("GET", r"/import/([^/]+)/filesets", self._list_filesets_in_import),
+            ("PUT", r"/import/([^/]+)", self._update_import),
+            ("GET", r"/fileset/([^/]+)/images", self._list_images_in_fileset),
+            ("POST", r"/image", self._create_image),
+            ("GET", r"/image/([^/]+)/credentials", self._image_credentials),
+            ("GET", r"/image/([^/]+)/dimensions", self._image_dimensions),
+            ("GET", r"/image/([^/]+)/metadata", self._image_metadata),
+            ("GET", r"/image/([^/]+)", self._get_image),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return handler(*match.groups(), query=query, body=body, headers=headers)
+        return 404, {"error": "No route for {} {}".format(method, path)}, {}
+
+    def _list_repositories(self, query, body, headers):
+        repositories = sorted(self.repositories.values(), key=lambda r: r["name"])
+        grants = [{"repository_uuid": r["uuid"], "permission": "Admin"} for r in repositories]
+        response = {"data": grants, "included": {"repositories": repositories}}
+        etag = '"{}"'.format(abs(hash(json.dumps(response, sort_keys=True))))
+        if headers.get("If-None-Match") == etag:
+            return 304, b"", {"ETag": etag}
+        return 200, response, {"ETag": etag}
+
+    def _create_repository(self, query, body, headers):
+        repository_uuid = self.add_repository(body["name"])
+        return 200, {"data": self.repositories[repository_uuid]}, {}
+
+    def _list_images_in_repository(self, repository_uuid, query, body, headers):
+        images = [image for image in self.images.values() if image["repository_uuid"] == repository_uuid]
+        if "limit" in query:
+            offset = int(query.get("offset", ["0"])[0])
+            images = images[offset:offset + int(query["limit"][0])]
+        return 200, {"data": images}, {}
+
+    def _create_import(self, query, body, headers):
+        import_uuid = str(uuid.uuid4())
+        self.imports[import_uuid] = {"uuid": import_uuid, "name": body["name"], "repository_uuid": body["repository_uuid"],
+                                     "complete": False}
+        return 200, {"data": self.imports[import_uuid]}, {}
+
+    def _import_credentials(self, import_uuid, query, body, headers):
+        self.imports[import_uuid]
+        expiration = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(time.time() + 3600))
+        return 200, {"data": {"url": "s3://{}/{}/".format(RAW_BUCKET, import_uuid),
+                              "credentials": dict(FAKE_CREDENTIALS, Expiration=expiration)}}, {}
+
+    def _update_import(self, import_uuid, query, body, headers):
+        imp = self.imports[import_uuid]
+        imp["complete"] = bool(body.get("complete"))
+        # Every uploaded raw file becomes one fileset, which is processed while it is polled
+        keys = []
+        if self.s3 is not None:
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=RAW_BUCKET, Prefix=import_uuid + "/"):
+                keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        for key in keys:
+            fileset_uuid = str(uuid.uuid4())
+            self.filesets[fileset_uuid] = {"uuid": fileset_uuid, "name": os.path.basename(key), "import_uuid": import_uuid,
+                                           "complete": False, "progress": 0}
+        return 200, {"data": imp}, {}
+
+    def _list_filesets_in_import(self, import_uuid, query, body, headers):
+        filesets = [f for f in self.filesets.values() if f["import_uuid"] == import_uuid]
+        self._advance(filesets)
+        return 200, {"data": filesets}, {}
+
+    def _list_incomplete_imports(self, query, body, headers):
+        filesets = [f for f in self.filesets.values() if not f["complete"]]
+        self._advance(filesets)
+        incomplete = set(f["import_uuid"] for f in filesets if not f["complete"])
+        imports = [self.imports[import_uuid] for import_uuid in incomplete]
+        return 200, {"data": imports, "included": {"filesets": [f for f in filesets if not f["complete"]]}}, {}
+
+    def _advance(self, filesets):
+        for fileset in filesets:
+            if fileset["complete"]:
+                continue
+            fileset["progress"] = min(100, fileset["progress"] + math.ceil(100 / self.processing_polls))
+            if fileset["progress"] == 100:
+                fileset["complete"] = True
+                repository_uuid = self.imports[fileset["import_uuid"]]["repository_uuid"]
+                image_uuid = self.add_image(repository_uuid, fileset["name"])
+                self.images[image_uuid]["fileset_uuid"] = fileset["uuid"]
+
+    def _list_images_in_fileset(self, fileset_uuid, query, body, headers):
+        return 200, {"data": [image for image in self.images.values() if image["fileset_uuid"] == fileset_uuid]}, {}
+
+    def _create_image(self, query, body, headers):
+        image_uuid = self.add_image(body["repository_uuid"], body["name"], body.get("pyramid_levels", 1),
+                                    body.get("tile_size", 1024), body.get("format"))
+        return 200, {"data": self.images[image_uuid]}, {}
+
+    def _image_credentials(self, image_uuid, query, body, headers):
+        self.images[image_uuid]
+        return 200, {"data": {"image_url": "s3://{}/{}/".format(TILE_BUCKET, image_uuid),
+                              "credentials": FAKE_CREDENTIALS}}, {}
+
+    def _get_image(self, image_uuid, query, body, headers):
+        image = self.images[image_uuid]
+        return 200, {"data": image, "included": {"repositories": [self.repositories.get(image["repository_uuid"])]}}, {}
+
+    def _image_dimensions(self, image_uuid, query, body, headers):
+        image = self.images[image_uuid]
+        # Dimensions are read from the zarr written into the tile bucket
+        zarray = json.loads(self.s3.get_object(Bucket=TILE_BUCKET, Key=image_uuid + "/0/.zarray")["Body"].read())
+        _, channels, _, height, width = zarray["shape"]
+        pixels = {
+            "SizeX": width,
+            "SizeY": height,
+            "SizeC": channels,
+            "channels": [{"ID": "Channel:0:{}".format(c), "Name": "Channel {}".format(c)} for c in range(channels)]
+        }
+        return 200, {"data": {"image_uuid": image_uuid, "pixels": pixels}, "included": {"images": [image]}}, {}
+
+    def _image_metadata(self, image_uuid, query, body, headers):
+        self.images[image_uuid]
+        try:
+            xml = self.s3.get_object(Bucket=TILE_BUCKET, Key=image_uuid + "/metadata.xml")["Body"].read()
+        except Exception:
+            xml = b'<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"/>'
+        return 200, base64.b64encode(xml), {}
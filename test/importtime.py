@@ -0,0 +1,61 @@
+"""
+Startup time check for the Minerva CLI.
+
+Runs the CLI with "python -X importtime" for commands which should start quickly,
+and fails if a heavy module is imported or the import time exceeds the budget.
+
+Usage: python test/importtime.py [--budget-ms 300]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules which should never be imported before a command needs them
+HEAVY_MODULES = ["boto3", "botocore", "numpy", "zarr", "tifffile", "s3fs", "tqdm",
+                 "minerva_lib.client", "minerva_lib.importing", "minerva_lib.exporting"]
+
+# Code run for each scenario, exiting right after argument parsing
+SCENARIOS = {
+    "help": ["--help"],
+    "configure": ["configure", "--config", os.devnull],
+    "invalid": ["unknown-command"]
+}
+
+PARSE_ONLY = "import sys; sys.argv = ['minerva'] + {argv!r}; from minerva_cli import minerva; minerva.parse_arguments()"
+
+
+def measure(argv):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PARSE_ONLY.format(argv=argv)],
+                            cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [part.strip() for part in line[len("import time:"):].split("|")]
+        if parts[1].isdigit():
+            modules[parts[2]] = int(parts[1])
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the startup import time of Minerva CLI")
+    parser.add_argument("--budget-ms", type=int, default=300, help="Maximum cumulative import time per scenario")
+    args = parser.parse_args()
+
+    failed = False
+    for name, argv in SCENARIOS.items():
+        modules = measure(argv)
+        total_ms = modules.get("minerva_cli.minerva", 0) / 1000
+        heavy = [module for module in HEAVY_MODULES if module in modules]
+        ok = total_ms <= args.budget_ms and not heavy
+        failed = failed or not ok
+        print("{:<10} {:>8.1f} ms  {}{}".format(name, total_ms, "OK" if ok else "FAIL",
+                                              "  heavy imports: " + ", ".join(heavy) if heavy else ""))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,15 @@ import requests
 import json
 import time
 from requests import Request
-from minervalib.progress import ProgressPercentage
+from minerva_lib.util.progress import ProgressPercentage
 
 class MinervaMockClient:
 
     def __init__(self):
         self.repository_uuid = "4fa9e42c-3591-40e7-923a-6cbd24ba8260"
         self.import_uuid = "d362cb3d-7ea2-4301-be25-9b425cc868dc"
-        pass
+        self.fileset_uuid = "776d35d5-d33e-4fc9-bb67-9b9696a29736"
+        self.image_uuid = "0e6a4f2b-5f4c-4f0e-9c57-3b6f6f0f8a1d"
 
     def authenticate(self, username, password):
         logging.info("Logging in as %s", username)
@@ -43,15 +44,18 @@ class MinervaMockClient:
         return self._response({})
 
     def list_filesets_in_import(self, import_uuid):
-        return self._response([{"uuid": "776d35d5-d33e-4fc9-bb67-9b9696a29736", "name": "Fakename", "complete": True, "progress": 100}])
+        return self._response([{"uuid": self.fileset_uuid, "name": "Fakename", "complete": True, "progress": 100}])
 
     def list_images_in_fileset(self, fileset_uuid):
-        # TODO
-        return self._response([])
+        return self._response([{"uuid": self.image_uuid, "name": "Fakename", "fileset_uuid": fileset_uuid,
+                                "repository_uuid": self.repository_uuid, "pyramid_levels": 1, "tile_size": 1024,
+                                "format": "zarr", "deleted": False}])
 
     def get_image_dimensions(self, image_uuid):
-        # TODO
-        return self._response([])
+        image = {"uuid": image_uuid, "name": "Fakename", "pyramid_levels": 1, "tile_size": 1024}
+        pixels = {"SizeX": 1024, "SizeY": 1024, "SizeC": 1,
+                  "channels": [{"ID": "Channel:0:0", "Name": "DAPI"}]}
+        return self._response({"image_uuid": image_uuid, "pixels": pixels}, {"images": [image]})
 
     def _response(self, data, included={}):
         return {"data": data, "included": included}
@@ -60,5 +64,8 @@ class MockS3Uploader:
     def __init__(self):
         self.region = "us-earth-1"
 
-    def upload(self, filepath, bucket, object_name, credentials, callback: ProgressPercentage):
+    def upload_file(self, filepath, bucket, object_name, credentials, callback: ProgressPercentage = None):
         time.sleep(0.1)
+
+    def upload_data(self, data, bucket, object_name, credentials):
+        time.sleep(0.01)